@@ -0,0 +1,187 @@
+import abc
+import array
+import collections
+import logging
+
+import yapga.db
+import yapga.words
+
+
+log = logging.getLogger('yapga')
+
+# Metric name -> metric class, filled in by `metric`.
+METRICS = collections.OrderedDict()
+
+
+def metric(cls):
+    """Class decorator registering a `Metric` under its `name`."""
+    METRICS[cls.name] = cls
+    return cls
+
+
+class Metric(abc.ABC):
+    """An accumulator computing one result from a stream of changes.
+
+    `fields` are the parts of each change it reads (as for
+    `yapga.db.all_changes`), or None for the whole change. `add` is
+    called once with each change, and `show` prints the result.
+    Options given to `create` which a metric doesn't use are ignored.
+    """
+    name = None
+    fields = []
+
+    def __init__(self, **options):
+        pass
+
+    @abc.abstractmethod
+    def add(self, change):
+        pass
+
+    @abc.abstractmethod
+    def show(self):
+        pass
+
+
+def create(names=None, **options):
+    """Create the metrics registered as `names` (all of them if not
+    given), passing each `options`.
+    """
+    if names is None:
+        names = list(METRICS)
+    return [METRICS[name](**options) for name in names]
+
+
+def merge_fields(field_lists):
+    """Combine lists of fields into one projection, or None if any of
+    them is None. Fields inside other fields are dropped, since MongoDB
+    won't project both.
+    """
+    fields = set()
+    for f in field_lists:
+        if f is None:
+            return None
+        fields.update(f)
+
+    return sorted(
+        f for f in fields
+        if not any(f.startswith(other + '.') for other in fields))
+
+
+def run(db, metrics, batch_size=None):
+    """Feed every change in `db` to each of `metrics` in one pass,
+    reading only the fields they need. Returns the number of changes
+    read.
+    """
+    adds = [m.add for m in metrics]
+    count = 0
+    for change in yapga.db.all_changes(
+            db, merge_fields(m.fields for m in metrics), batch_size):
+        for add in adds:
+            add(change)
+        count += 1
+    return count
+
+
+@metric
+class RevisionCounts(Metric):
+    """Histogram of number of revisions per change."""
+    name = 'revision_counts'
+    fields = ['revisions']
+
+    def __init__(self, **options):
+        self.counts = collections.Counter()
+
+    def add(self, change):
+        self.counts[change.revision_count] += 1
+
+    def show(self):
+        print('# patchsets: # changes')
+        for revisions, count in sorted(self.counts.items()):
+            print('{:>11}: {}'.format(revisions, count))
+
+
+@metric
+class SizeVsCount(Metric):
+    """Correlation of the size of the first revision of each change
+    with its number of revisions.
+    """
+    name = 'size_vs_count'
+    fields = ['id', 'revisions']
+
+    def __init__(self, **options):
+        self.revision_counts = array.array('q')
+        self.sizes = array.array('q')
+
+    def add(self, change):
+        first = change.first_revision
+        if first is not None:
+            self.revision_counts.append(change.revision_count)
+            self.sizes.append(first.size())
+
+    def show(self):
+        import numpy
+        print('{} changes with revisions'.format(len(self.sizes)))
+        if len(self.sizes) > 1:
+            print('corr. coeff:',
+                  numpy.corrcoef([self.revision_counts, self.sizes]))
+
+
+@metric
+class ChangesByOwner(Metric):
+    """Number of changes by each owner."""
+    name = 'changes_by_owner'
+    fields = ['owner.name']
+
+    def __init__(self, **options):
+        self.counts = collections.Counter()
+
+    def add(self, change):
+        self.counts[change.data.get('owner', {}).get('name', 'UNKNOWN')] += 1
+
+    def show(self):
+        for name, count in sorted(self.counts.items(),
+                                  key=lambda x: (x[1], x[0])):
+            print((count // 10) * '*', name)
+
+
+@metric
+class MessagesByUser(Metric):
+    """Number of changes and review messages by each user."""
+    name = 'messages_by_user'
+    fields = ['owner.name', 'messages.author.name']
+
+    def __init__(self, **options):
+        self.changes = collections.Counter()
+        self.messages = collections.Counter()
+
+    def add(self, change):
+        self.changes[change.data.get('owner', {}).get('name', 'UNKNOWN')] += 1
+        for msg in change.data.get('messages', ()):
+            author = msg.get('author')
+            if author is not None:
+                self.messages[author.get('name', 'UNKNOWN')] += 1
+
+    def show(self):
+        print('changes messages user')
+        for name in sorted(set(self.changes) | set(self.messages)):
+            print('{:>7} {:>8} {}'.format(
+                self.changes[name], self.messages[name], name))
+
+
+@metric
+class WordCounts(Metric):
+    """The `count` most common words in review messages."""
+    name = 'word_count'
+    fields = yapga.db.MESSAGE_FIELDS
+
+    def __init__(self, count=20, **options):
+        self.count = int(count)
+        self.counts = collections.Counter()
+
+    def add(self, change):
+        self.counts.update(
+            yapga.words.message_words(m.message for m in change.messages))
+
+    def show(self):
+        for word, count in reversed(self.counts.most_common(self.count)):
+            print(count // 1000 * '*', count, word)
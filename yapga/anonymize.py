@@ -0,0 +1,300 @@
+import collections.abc
+import concurrent.futures
+import hashlib
+import hmac
+import json
+import logging
+import os
+
+from yapga.util import (is_json_array, iter_json_array, iter_json_lines,
+                        open_file)
+
+
+log = logging.getLogger('yapga')
+
+NAME_TEMPLATE = 'UNKNOWN_{}'
+MAIL_TEMPLATE = 'UNKNOWN_{}@UNKNOWN.UNK'
+
+
+def _children(obj):
+    # An iterator over the (mapping, key) or (None, item) pairs in OBJ,
+    # or None if it's not a container.
+    if isinstance(obj, str):
+        return None
+
+    if isinstance(obj, collections.abc.Mapping):
+        return ((obj, k) for k in obj)
+
+    if isinstance(obj, collections.abc.Sequence):
+        return ((None, x) for x in obj)
+
+    return None
+
+
+def json_transform(obj, t):
+    """Walk OBJ as a mapping or sequence, calling T with each
+    key-value mapping and replacing the values in the data structure
+    with the return values.
+
+    Values are visited depth-first in document order, without
+    recursion, so deeply nested structures can't overflow the stack.
+    """
+    stack = []
+    children = _children(obj)
+    if children is not None:
+        stack.append(children)
+
+    while stack:
+        for mapping, item in stack[-1]:
+            if mapping is not None:
+                key = item
+                item = t(key, mapping[key])
+                mapping[key] = item
+
+            children = _children(item)
+            if children is not None:
+                stack.append(children)
+                break
+        else:
+            stack.pop()
+
+
+class Replacer:
+    """A callable that fills in TEMPLATE with increasing integer
+    values each time it's called.
+    """
+    def __init__(self, template):
+        self.template = template
+        self.counter = 0
+
+    def __call__(self):
+        self.counter += 1
+        return self.template.format(self.counter)
+
+
+class KeyedPseudonyms(dict):
+    """A map from values to pseudonyms made by filling in TEMPLATE
+    with a keyed hash (HMAC-SHA256) of each value. The same KEY always
+    gives the same pseudonyms, whatever order values are seen in.
+    """
+    def __init__(self, key, template):
+        super().__init__()
+        self.key = key.encode('utf-8')
+        self.template = template
+
+    def __missing__(self, value):
+        digest = hmac.new(self.key, value.encode('utf-8'),
+                          hashlib.sha256).hexdigest()[:16]
+        pseudonym = self[value] = self.template.format(digest)
+        return pseudonym
+
+
+def pseudonyms(template, known=None, key=None):
+    """Make a map from values to pseudonyms, starting with the ones in
+    KNOWN. New values get a keyed hash if KEY is given, and otherwise
+    the next number (after those already used in KNOWN.)
+    """
+    if key is not None:
+        result = KeyedPseudonyms(key, template)
+    else:
+        replacer = Replacer(template)
+        replacer.counter = len(known or {})
+        result = collections.defaultdict(replacer)
+
+    result.update(known or {})
+    return result
+
+
+class Anonymizer:
+    """A callable replacing (in place) the names and email addresses
+    in a JSON value with pseudonyms. Each distinct name or address gets
+    the same pseudonym every time it's seen.
+
+    NAME_MAP and MAIL_MAP map values to their pseudonyms. By default
+    pseudonyms are numbered in the order values are first seen.
+    """
+    def __init__(self, name_map=None, mail_map=None):
+        if name_map is None:
+            name_map = pseudonyms(NAME_TEMPLATE)
+        if mail_map is None:
+            mail_map = pseudonyms(MAIL_TEMPLATE)
+        self.name_map = name_map
+        self.mail_map = mail_map
+
+    def anon(self, key, value):
+        if not isinstance(value, str):
+            return value
+
+        if key == 'email':
+            return self.mail_map[value]
+
+        if key == 'name':
+            return self.name_map[value]
+
+        return value
+
+    def __call__(self, obj):
+        json_transform(obj, self.anon)
+        return obj
+
+
+def read_changes(f):
+    """Read the changes from the binary file F, which holds either a
+    JSON array or JSON Lines. Returns whether it's an array and an
+    iterator over the changes, which are parsed as they're needed.
+    """
+    if is_json_array(f):
+        return True, iter_json_array(f)
+    return False, iter_json_lines(f)
+
+
+def write_changes(f, changes, as_array):
+    """Write CHANGES to the text file F as they're generated, either
+    as a JSON array or as JSON Lines.
+    """
+    if as_array:
+        f.write('[')
+        for i, change in enumerate(changes):
+            if i:
+                f.write(', ')
+            f.write(json.dumps(change))
+        f.write(']')
+    else:
+        for change in changes:
+            f.write(json.dumps(change))
+            f.write('\n')
+
+
+def anonymize_file(infile, outfile, anonymizer=None):
+    """Read the changes from INFILE, anonymize them with ANONYMIZER (a
+    new `Anonymizer` by default) and write the results to OUTFILE.
+
+    INFILE may hold a JSON array or JSON Lines, and OUTFILE is written
+    in the same format. Either may be gzipped (if its name ends in
+    '.gz'.) Changes are read, anonymized and written one at a time, so
+    memory use doesn't grow with the size of the input.
+    """
+    if anonymizer is None:
+        anonymizer = Anonymizer()
+
+    with open_file(infile, 'rb') as inf, open_file(outfile, 'wt') as outf:
+        as_array, changes = read_changes(inf)
+        write_changes(outf, map(anonymizer, changes), as_array)
+
+
+def collect_identities(infile):
+    """Get the distinct names and email addresses in the changes in
+    INFILE, each in the order they're first seen.
+    """
+    names = {}
+    mails = {}
+
+    def collect(key, value):
+        if isinstance(value, str):
+            if key == 'name':
+                names.setdefault(value)
+            elif key == 'email':
+                mails.setdefault(value)
+        return value
+
+    with open_file(infile, 'rb') as f:
+        for change in read_changes(f)[1]:
+            json_transform(change, collect)
+
+    return list(names), list(mails)
+
+
+def load_mapping(filename):
+    """Load the names and email address maps saved by `save_mapping`,
+    or empty ones if FILENAME doesn't exist.
+    """
+    try:
+        with open(filename, 'rt') as f:
+            mapping = json.load(f)
+    except FileNotFoundError:
+        return {}, {}
+    return mapping['names'], mapping['emails']
+
+
+def save_mapping(filename, name_map, mail_map):
+    with open(filename + '.tmp', 'wt') as f:
+        json.dump({'names': dict(name_map), 'emails': dict(mail_map)}, f)
+    os.replace(filename + '.tmp', filename)
+
+
+# The anonymizer used by each worker process of `anonymize_shards`.
+_anonymizer = None
+
+
+def _init_worker(name_map, mail_map, key):
+    global _anonymizer
+    if key is not None:
+        name_map = pseudonyms(NAME_TEMPLATE, name_map, key)
+        mail_map = pseudonyms(MAIL_TEMPLATE, mail_map, key)
+    _anonymizer = Anonymizer(name_map, mail_map)
+
+
+def _anonymize_shard(infile, outfile):
+    anonymize_file(infile, outfile, _anonymizer)
+
+    # Keyed pseudonyms are made by the workers, so they're sent back
+    # to be saved.
+    if isinstance(_anonymizer.name_map, KeyedPseudonyms):
+        return dict(_anonymizer.name_map), dict(_anonymizer.mail_map)
+    return None
+
+
+def anonymize_shards(indir, outdir, jobs=4, mapping=None, key=None):
+    """Anonymize every file of changes in INDIR (as for
+    `anonymize_file`), writing the results to files of the same
+    names in OUTDIR. Up to JOBS files are processed at once, each in
+    its own process.
+
+    Pseudonyms are consistent across files. By default a first pass
+    collects the names and addresses in every file, and they're
+    numbered in the order a single `anonymize_file` of the files
+    (in name order) would number them. With KEY, pseudonyms are
+    instead a keyed hash of each value and the first pass is skipped.
+
+    If MAPPING is given, pseudonyms already saved in that file are
+    reused, and the updated mapping is saved back to it so that later
+    exports get the same pseudonyms.
+    """
+    infiles = sorted(f for f in os.listdir(indir)
+                     if os.path.isfile(os.path.join(indir, f)))
+    os.makedirs(outdir, exist_ok=True)
+
+    name_map, mail_map = {}, {}
+    if mapping:
+        name_map, mail_map = load_mapping(mapping)
+
+    if key is None:
+        name_map = pseudonyms(NAME_TEMPLATE, name_map)
+        mail_map = pseudonyms(MAIL_TEMPLATE, mail_map)
+        with concurrent.futures.ProcessPoolExecutor(int(jobs)) as pool:
+            for names, mails in pool.map(
+                    collect_identities,
+                    [os.path.join(indir, f) for f in infiles]):
+                for name in names:
+                    name_map[name]
+                for mail in mails:
+                    mail_map[mail]
+        log.info('Found {} names and {} email addresses'.format(
+            len(name_map), len(mail_map)))
+
+    # Workers are given the complete maps when they start.
+    with concurrent.futures.ProcessPoolExecutor(
+            int(jobs),
+            initializer=_init_worker,
+            initargs=(dict(name_map), dict(mail_map), key)) as pool:
+        results = pool.map(_anonymize_shard,
+                           [os.path.join(indir, f) for f in infiles],
+                           [os.path.join(outdir, f) for f in infiles])
+        for infile, result in zip(infiles, results):
+            log.info('Anonymized {}'.format(infile))
+            if result is not None:
+                name_map.update(result[0])
+                mail_map.update(result[1])
+
+    if mapping:
+        save_mapping(mapping, name_map, mail_map)
@@ -1,72 +1,34 @@
-import collections.abc
-import json
-
 import baker
 
-# from yapga.util import open_file
-
-
-def json_transform(obj, t):
-    """Walk OBJ as a mapping or sequence, calling T with each
-    key-value mapping and replacing the values in the data structure
-    with the return values.
-    """
-    if isinstance(obj, str):
-        return
-
-    if isinstance(obj, collections.abc.Mapping):
-        for k, v in obj.items():
-            obj[k] = t(k, v)
-            json_transform(obj[k], t)
-
-    elif isinstance(obj, collections.abc.Sequence):
-        for x in obj:
-            json_transform(x, t)
-
-
-class Replacer:
-    """A callable that fills in TEMPLATE with increasing integer
-    values each time it's called.
-    """
-    def __init__(self, template):
-        self.template = template
-        self.counter = 0
-
-    def __call__(self):
-        self.counter += 1
-        return self.template.format(self.counter)
+import yapga.anonymize
 
 
 @baker.command
 def anonymize_changes(infile, outfile):
     """Read the changes from INFILE, anonymize names and email
     addresses, and write the results to OUTFILE.
-    """
-    with open_file(infile, 'rt') as f:
-        changes = json.loads(f.read())
-
-    name_map = collections.defaultdict(
-        Replacer('UNKNOWN_{}'))
-    mail_map = collections.defaultdict(
-        Replacer('UNKNOWN_{}@UNKNOWN.UNK'))
-
-    def anon(key, value):
-        if not isinstance(value, str):
-            return value
-
-        if key == 'email':
-            return mail_map[value]
-
-        if key == 'name':
-            return name_map[value]
 
-        return value
-
-    def anon_test(k, v):
-        rslt = anon(k, v)
-        return rslt
+    INFILE may hold a JSON array or JSON Lines, and OUTFILE is written
+    in the same format. Either may be gzipped (if its name ends in
+    '.gz'.)
+    """
+    yapga.anonymize.anonymize_file(infile, outfile)
 
-    json_transform(changes, anon_test)
 
-    with open_file(outfile, 'wt') as f:
-        json.dump(changes, f)
+@baker.command
+def anonymize_shards(indir, outdir, jobs=4, mapping=None, key=None):
+    """Anonymize every file of changes in INDIR (as for
+    `anonymize_changes`), writing the results to files of the same
+    names in OUTDIR. Up to JOBS files are processed at once, each in
+    its own process.
+
+    Pseudonyms are consistent across files. By default they're
+    numbered in the order a single `anonymize_changes` of the files
+    (in name order) would number them. With KEY, pseudonyms are
+    instead a keyed hash of each value.
+
+    If MAPPING is given, pseudonyms already saved in that file are
+    reused, and the updated mapping is saved back to it so that later
+    exports get the same pseudonyms.
+    """
+    yapga.anonymize.anonymize_shards(indir, outdir, jobs, mapping, key)
@@ -0,0 +1,321 @@
+import collections.abc
+import copy
+import os
+import random
+import time
+import tracemalloc
+
+import baker
+
+import yapga.db
+import yapga.gerrit_api
+import yapga.util
+import yapga.words
+
+
+def _timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def _exhaust(it):
+    for _ in it:
+        pass
+
+
+def _print_table(title, columns, rows):
+    print(title)
+    print('{:<28}'.format('') + ''.join('{:>12}'.format(c) for c in columns))
+    for name, values in rows:
+        print('{:<28}'.format(name) +
+              ''.join('{:>12.3f}'.format(v) for v in values))
+
+
+@baker.command
+def bench_storage(dbname,
+                  sqlite_path,
+                  mongo_host=yapga.db.DEFAULT_MONGO_HOST,
+                  mongo_port=yapga.db.DEFAULT_MONGO_PORT,
+                  lookups=1000,
+                  batch_size=500):
+    """Compare the MongoDB database `dbname` with a copy of it in the
+    SQLite file `sqlite_path` (which is overwritten.) Prints the time
+    in seconds taken by each backend for the same operations.
+    """
+    import yapga.snapshot
+
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(sqlite_path + suffix):
+            os.remove(sqlite_path + suffix)
+
+    with yapga.db.get_db(dbname, mongo_host, mongo_port) as mongo_db, \
+            yapga.db.get_db('sqlite:' + sqlite_path) as sqlite_db:
+        dbs = [mongo_db, sqlite_db]
+
+        # Copy the corpus, timing the batched inserts into SQLite.
+        copy_time = 0.0
+        changes = (
+            {k: v for k, v in c.data.items() if k != '_id'}
+            for c in yapga.db.all_changes(mongo_db))
+        for chunk in (list(c) for c in yapga.util.chunks(changes,
+                                                          batch_size)):
+            if not chunk:
+                break
+            copy_time += _timed(
+                lambda: yapga.db.insert_changes(sqlite_db, chunk))
+
+        reviews = [(change_id, [r.data for r in reviewers])
+                   for change_id, reviewers
+                   in yapga.db.all_reviewers(mongo_db)]
+        copy_time += _timed(
+            lambda: yapga.db.insert_reviews(sqlite_db, reviews))
+
+        change_ids = [c for c, _ in reviews] or ['']
+        sample = [random.choice(change_ids) for _ in range(lookups)]
+
+        benchmarks = [
+            ('scan all_changes',
+             lambda db: _exhaust(yapga.db.all_changes(db))),
+            ('scan snapshot fields',
+             lambda db: _exhaust(yapga.db.all_changes(
+                 db, yapga.snapshot.CHANGE_FIELDS))),
+            ('{} get_reviewers'.format(lookups),
+             lambda db: [list(yapga.db.get_reviewers(db, c))
+                         for c in sample]),
+            ('changes_missing_reviewers',
+             lambda db: _exhaust(yapga.db.changes_missing_reviewers(db))),
+            ('owner_change_counts',
+             lambda db: _exhaust(yapga.db.owner_change_counts(db))),
+            ('reviewer_owner_counts',
+             lambda db: _exhaust(yapga.db.reviewer_owner_counts(db))),
+            ('build snapshot',
+             lambda db: yapga.snapshot.build(db)),
+        ]
+
+        print('Copied {} changes and {} reviews into SQLite in {:.3f}s'.format(
+            yapga.db.content_state(sqlite_db)['changes'],
+            len(reviews),
+            copy_time))
+
+        _print_table('Time (s)', ['MongoDB', 'SQLite'],
+                     [(name, [_timed(lambda: func(db)) for db in dbs])
+                      for name, func in benchmarks])
+
+
+def _recursive_escape_struct(s):
+    # The original, recursive `yapga.db.escape_struct`, for comparison.
+    if not isinstance(s, collections.abc.Mapping):
+        return s
+
+    for k, v in list(s.items()):
+        del s[k]
+        s[k.replace('.', '<DOT>').replace('$', '<DOLLAR_SIGN>')] = \
+            _recursive_escape_struct(v)
+
+    return s
+
+
+def _synthetic_change(revisions, files):
+    return {
+        'change_id': 'I0',
+        'revisions': {
+            'rev{}'.format(r): {
+                '_number': r,
+                'files': {
+                    'src/module{}/file{}.py'.format(f % 10, f): {
+                        'lines_inserted': f, 'lines_deleted': r}
+                    for f in range(files)},
+            }
+            for r in range(revisions)},
+        'messages': [{'message': 'Patch Set {}: Looks good'.format(r),
+                      'author': {'name': 'someone'}}
+                     for r in range(revisions)],
+    }
+
+
+@baker.command
+def bench_escape(count=100, revisions=5, files=1000):
+    """Time escaping `count` synthetic changes with `revisions`
+    revisions of `files` files each, and unescaping them again.
+    """
+    change = _synthetic_change(revisions, files)
+
+    def run(func, source):
+        changes = [copy.deepcopy(source) for _ in range(count)]
+        return _timed(lambda: [func(c) for c in changes])
+
+    escaped = yapga.db.escape_struct(copy.deepcopy(change))
+    _print_table(
+        'Time (s) for {} changes with {} keys each'.format(
+            count, revisions * (files + 2)),
+        ['Time'],
+        [('recursive escape_struct',
+          [run(_recursive_escape_struct, change)]),
+         ('escape_struct', [run(yapga.db.escape_struct, change)]),
+         ('unescape_struct', [run(yapga.db.unescape_struct, escaped)])])
+
+
+class _EagerChangeMessage:
+    # The original `yapga.gerrit_api.ChangeMessage`, for comparison.
+    def __init__(self, data):
+        self.data = data
+        self.id = self.data.get('id', 'UNKNOWN')
+
+        try:
+            self.author = yapga.gerrit_api.Account(self.data['author'])
+        except KeyError:
+            self.author = None
+
+        self.date = self.data['date']
+        self.message = self.data['message']
+        self.revision_number = self.data.get('_revision_number', 0)
+
+
+def _traced(func):
+    """Run `func`, returning the time it took and the peak memory (in
+    bytes) it allocated.
+    """
+    tracemalloc.start()
+    try:
+        elapsed = _timed(func)
+        return elapsed, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@baker.command
+def bench_models(dbname,
+                 mongo_host=yapga.db.DEFAULT_MONGO_HOST,
+                 mongo_port=yapga.db.DEFAULT_MONGO_PORT):
+    """Compare the time and memory used to scan every change in
+    `dbname` by building model objects with those used by the counting
+    accessors which don't.
+    """
+    with yapga.db.get_db(dbname, mongo_host, mongo_port) as db:
+        changes = list(yapga.db.all_changes(db))
+
+    def wrappers():
+        for c in changes:
+            len(list(c.revisions))
+            len(list(c.messages))
+            revs = c.data.get('revisions', {})
+            if revs:
+                next(c.revisions).size()
+
+    def accessors():
+        for c in changes:
+            c.revision_count
+            c.message_count
+            first = c.first_revision
+            if first is not None:
+                first.size()
+
+    messages = [m for c in changes for m in c.data.get('messages', [])]
+
+    def retained(cls):
+        return lambda: [cls(m) for m in messages]
+
+    rows = [('count with wrappers', _traced(wrappers)),
+            ('count with accessors', _traced(accessors)),
+            ('keep eager messages', _traced(retained(_EagerChangeMessage))),
+            ('keep lazy messages',
+             _traced(retained(yapga.gerrit_api.ChangeMessage)))]
+
+    _print_table(
+        '{} changes, {} messages'.format(len(changes), len(messages)),
+        ['Time (s)', 'Peak (KiB)'],
+        [(name, [elapsed, peak / 1024]) for name, (elapsed, peak) in rows])
+
+
+@baker.command
+def bench_attributes(count=1000000):
+    """Time reading the `id`, `change_id` and revision `_number` of
+    `count` changes through the declared fields and through the
+    `__getattr__` fallback.
+    """
+    count = int(count)
+    data = _synthetic_change(1, 1)
+    data['id'] = 'project~master~I0'
+    change = yapga.gerrit_api.Change(data)
+    fallback = yapga.gerrit_api.JSONObject(data)
+    revision = change.first_revision
+    dynamic_revision = yapga.gerrit_api.JSONObject(revision.data)
+
+    def read(obj, name):
+        def run():
+            for _ in range(count):
+                getattr(obj, name)
+        return run
+
+    rows = []
+    for name, obj, dynamic in (('id', change, fallback),
+                               ('change_id', change, fallback),
+                               ('_number', revision, dynamic_revision)):
+        rows.append((name, [_timed(read(obj, name)),
+                            _timed(read(dynamic, name))]))
+
+    _print_table('Time (s) for {} lookups'.format(count),
+                 ['Field', '__getattr__'],
+                 rows)
+
+
+def _old_filter_messages(messages, skip_res, trim_res):
+    # The original `yapga.words.filter_messages`, for comparison.
+    import re
+    for msg in messages:
+        if any(re.match(patt, msg) for patt in skip_res):
+            continue
+
+        for patt in trim_res:
+            match = re.search(patt, msg)
+            if match:
+                msg = ' '.join(match.groups())
+
+        yield msg
+
+
+@baker.command
+def bench_words(dbname,
+                mongo_host=yapga.db.DEFAULT_MONGO_HOST,
+                mongo_port=yapga.db.DEFAULT_MONGO_PORT):
+    """Time filtering and splitting every review message in `dbname`
+    into words with the original and the compiled pipelines. The
+    original is given uppercased stopwords, so both count the same
+    words.
+    """
+    with yapga.db.get_db(dbname, mongo_host, mongo_port) as db:
+        messages = [m.message
+                    for c in yapga.db.all_changes(db, yapga.db.MESSAGE_FIELDS)
+                    for m in c.messages]
+
+    upper_skip_words = set(w.upper() for w in yapga.words.skip_words())
+    counts = {}
+
+    def old():
+        filtered = _old_filter_messages(messages, yapga.words.skip_res,
+                                        yapga.words.trim_res)
+        counts['original'] = sum(1 for _ in filter(
+            lambda x: x.upper() not in upper_skip_words,
+            (w for m in filtered for w in m.split())))
+
+    def new():
+        counts['compiled'] = sum(
+            1 for _ in yapga.words.message_words(messages))
+
+    rows = [('original', [_timed(old)]), ('compiled', [_timed(new)])]
+    _print_table('Time (s) for {} messages'.format(len(messages)),
+                 ['Time'], rows)
+    for name, count in sorted(counts.items()):
+        print('{} pipeline: {} words'.format(name, count))
+
+
+@baker.command
+def bench_startup(module='yapga.app.main', count=15):
+    """Show the `count` slowest imports made when importing `module`
+    in a fresh interpreter, as measured by `python -X importtime`.
+    """
+    times = yapga.util.import_times(module)
+    slowest = sorted(times.items(), key=lambda x: -x[1])[:count]
+    _print_table('Cumulative import time (ms)', ['Time'],
+                 [(name, [t / 1000]) for name, t in slowest])
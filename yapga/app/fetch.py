@@ -1,15 +1,8 @@
-import itertools
-import json
-import logging
-
 import baker
 
 import yapga
 import yapga.db
-import yapga.util
-
-
-log = logging.getLogger('yapga')
+import yapga.fetch
 
 
 @baker.command
@@ -22,45 +15,65 @@ def fetch(url,
           count=None,
           batch_size=500,
           start_at=None,
-          status='merged'):
+          status='merged',
+          workers=1,
+          write_concern=None,
+          pooled=False,
+          gzip=False,
+          stream=False,
+          incremental=False,
+          resume=False,
+          retries=3):
     """Fetch up to `count` changes from the gerrit server at `url`,
     grabbing them in batches of `batch_size`. The results are saved as
     a JSON list of `ChangeInfo` objects into `filename`.
 
     If `username` and `password` are supplied, then they are used for
     digest authentication with the server.
-    """
-    with yapga.db.get_db(dbname,
-                           mongo_host,
-                           mongo_port) as db:
-        queries = ['q=status:{}'.format(status),
-                   'o=ALL_REVISIONS',
-                   'o=ALL_FILES',
-                   'o=ALL_COMMITS',
-                   'o=MESSAGES',
-                   'n={}'.format(batch_size)]
 
-        if start_at is not None:
-            queries.append('N={}'.format(start_at))
+    If `workers` is greater than one, pages are downloaded in a
+    background thread while up to `workers` batches are written to the
+    database concurrently. Batches are committed in order, so the
+    last logged sort key can always be passed as `start_at` to resume.
+
+    Each batch is upserted with a single bulk write using
+    `write_concern` (e.g. 0, 1 or 'majority') if it is given.
 
-        if count is not None:
-            count = int(count)
+    If `pooled` is set, HTTP connections are kept alive and reused
+    between requests, and `gzip` asks the server to compress its
+    responses. With `stream` each page is parsed incrementally, one
+    change at a time, instead of being loaded into memory at once.
 
-        conn = yapga.create_connection(url, username, password)
-        chunks = yapga.util.chunks(
-            itertools.islice(yapga.fetch_changes(conn, queries=queries),
-                             count),
-            batch_size)
+    With `incremental`, only changes updated since the last complete
+    incremental fetch of `status` changes from `url` into `dbname` are
+    requested (using an `after:` query.) The newest `updated` timestamp
+    seen is recorded once the whole crawl succeeds; if there's no
+    record yet, the newest change with that status already in the
+    database is used.
 
-        try:
-            for chunk in (list(c) for c in chunks):
-                if not chunk:
-                    break
-                for change in chunk:
-                    yapga.db.insert_change(db, change)
-        except Exception:
-            log.exception(
-                'Error fetching results. Partial results saved.')
+    After every committed batch the last sort key is checkpointed in
+    the `crawl_state` collection. With `resume`, an interrupted crawl
+    of the same `url` and `status` carries on from its checkpoint.
+    Requests failing with transient errors are retried up to `retries`
+    times with exponential backoff, continuing after the last change
+    received.
+    """
+    with yapga.db.get_db(dbname,
+                         mongo_host,
+                         mongo_port) as db:
+        conn = yapga.create_connection(url, username, password,
+                                       pooled=pooled, gzip=gzip)
+        yapga.fetch.fetch(db, conn, url,
+                          count=count,
+                          batch_size=batch_size,
+                          start_at=start_at,
+                          status=status,
+                          workers=workers,
+                          write_concern=write_concern,
+                          stream=stream,
+                          incremental=incremental,
+                          resume=resume,
+                          retries=retries)
 
 
 @baker.command
@@ -69,28 +82,38 @@ def fetch_reviewers(url,
                     mongo_host=yapga.db.DEFAULT_MONGO_HOST,
                     mongo_port=yapga.db.DEFAULT_MONGO_PORT,
                     username=None,
-                    password=None):
+                    password=None,
+                    workers=1,
+                    rate=0.0,
+                    retries=3,
+                    batch_size=100,
+                    write_concern=None,
+                    pooled=False,
+                    gzip=False):
     """Fetch all reviewers for the changes in `changes` collection from `url`. The
     results are written to the `reviewers` collection as a json map from change-id to
     review-list.
-    """
 
+    Only changes without reviewers in the database are fetched. Up to
+    `workers` requests are made concurrently, limited to `rate`
+    requests per second if `rate` is positive. Each request is tried
+    up to `retries` times, and results are written in bulk batches of
+    `batch_size` using `write_concern` if it is given. `pooled` and
+    `gzip` are as for `fetch`.
+
+    Progress is checkpointed in the `crawl_state` collection after
+    every batch. Since only changes without reviewers are fetched,
+    rerunning the command resumes an interrupted crawl, or retries the
+    changes which failed.
+    """
     with yapga.db.get_db(dbname,
                          mongo_host,
                          mongo_port) as db:
-        conn = yapga.create_connection(url, username, password)
-
-        for c in yapga.db.all_changes(db):
-            try:
-                if yapga.util.is_empty(
-                        yapga.db.get_reviewers(db, c.change_id)):
-                    print('Fetching reviewers for change {}'.format(c.change_id))
-                    yapga.db.insert_reviewers(
-                        db,
-                        c.change_id,
-                        yapga.fetch_reviewers(conn, c.change_id))
-                else:
-                    print('Reviews already found for {}'.format(c.change_id))
-            except Exception:
-                log.exception(
-                    'Error fetching reviewers for change {}'.format(c.change_id))
+        conn = yapga.create_connection(url, username, password,
+                                       pooled=pooled, gzip=gzip)
+        yapga.fetch.fetch_reviewers(db, conn, url,
+                                    workers=workers,
+                                    rate=rate,
+                                    retries=retries,
+                                    batch_size=batch_size,
+                                    write_concern=write_concern)
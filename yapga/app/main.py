@@ -1,6 +1,6 @@
 import baker
 
-from . import anonymize, fetch, misc, words
+from . import anonymize, bench, fetch, misc, report, words
 
 def main():
     baker.run()
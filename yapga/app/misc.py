@@ -1,16 +1,29 @@
 import collections
-import itertools
 import logging
+import sqlite3
 
 import baker
-import numpy as np
+import pymongo.errors
 
 import yapga.db
+import yapga.util
 
 
 log = logging.getLogger('yapga')
 
 
+def _aggregate(db, *funcs):
+    """Run the aggregation functions `funcs` on `db`, returning a
+    list of their results, or None if the server couldn't run them.
+    """
+    try:
+        return [list(f(db)) for f in funcs]
+    except (pymongo.errors.OperationFailure, sqlite3.OperationalError):
+        log.warning('Aggregation failed. Falling back to a full scan.',
+                    exc_info=True)
+        return None
+
+
 @baker.command
 def list_changes(dbname,
                  mongo_host=yapga.db.DEFAULT_MONGO_HOST,
@@ -28,19 +41,19 @@ def list_changes(dbname,
 def rev_size_vs_count(dbname,
                       mongo_host=yapga.db.DEFAULT_MONGO_HOST,
                       mongo_port=yapga.db.DEFAULT_MONGO_PORT,
-                      outfile=None):
+                      outfile=None,
+                      cache_dir=yapga.util.DEFAULT_CACHE_DIR):
     """Log-x scatter of patch size vs. # of commits
     to a review.
     """
-    data = []
+    import yapga.snapshot
 
     with yapga.db.get_db(dbname, mongo_host, mongo_port) as db:
-        for c in yapga.db.all_changes(db):
-            revs = list(c.revisions)
-            if revs:
-                data.append([len(revs), revs[0].size()])
+        snapshot = yapga.snapshot.load(db, cache_dir)
 
-    data = list(zip(*data))
+    has_revs = snapshot.revision_count > 0
+    data = [snapshot.revision_count[has_revs],
+            snapshot.first_revision_size[has_revs]]
 
     import numpy
     print('corr. coeff:', numpy.corrcoef(data))
@@ -68,15 +81,17 @@ def rev_size_vs_count(dbname,
 def rev_count_hist(dbname,
                    mongo_host=yapga.db.DEFAULT_MONGO_HOST,
                    mongo_port=yapga.db.DEFAULT_MONGO_PORT,
-                   outfile=None):
+                   outfile=None,
+                   cache_dir=yapga.util.DEFAULT_CACHE_DIR):
     "Histogram of number of revision per change."
+    import yapga.snapshot
 
     with yapga.db.get_db(dbname, mongo_host, mongo_port) as db:
-        changes = list(yapga.db.all_changes(db))
+        snapshot = yapga.snapshot.load(db, cache_dir)
 
-    log.info('Scanning {} changes'.format(len(changes)))
+    log.info('Scanning {} changes'.format(len(snapshot)))
 
-    vals = [len(list(c.revisions)) for c in changes]
+    vals = snapshot.revision_count
 
     import matplotlib.pyplot as plt
 
@@ -95,16 +110,26 @@ def rev_count_hist(dbname,
 @baker.command
 def changes_by_owner(dbname,
                      mongo_host=yapga.db.DEFAULT_MONGO_HOST,
-                     mongo_port=yapga.db.DEFAULT_MONGO_PORT):
-    "Simple histogram of change count by owners."
-    counts = {}
+                     mongo_port=yapga.db.DEFAULT_MONGO_PORT,
+                     cache_dir=yapga.util.DEFAULT_CACHE_DIR,
+                     use_snapshot=False):
+    """Simple histogram of change count by owners.
+
+    The counting is done on the server with an aggregation pipeline,
+    unless `use_snapshot` is set (or the server can't do it.)
+    """
+    import yapga.snapshot
 
     with yapga.db.get_db(dbname, mongo_host, mongo_port) as db:
-        for change in yapga.db.all_changes(db):
-            o = change.owner.name
-            counts[o] = counts.get(o, 0) + 1
+        results = None
+        if not use_snapshot:
+            results = _aggregate(db, yapga.db.owner_change_counts)
 
-    counts = sorted(counts.items(), key=lambda x: x[1])
+        if results is None:
+            snapshot = yapga.snapshot.load(db, cache_dir)
+            results = [snapshot.counts(snapshot.owner)]
+
+    counts = sorted(results[0], key=lambda x: x[1])
     for c in counts:
         print((c[1] // 10) * '*', c[0])
 
@@ -116,7 +141,7 @@ def list_messages(dbname,
     "List all of the change messages in a changes file."
 
     with yapga.db.get_db(dbname, mongo_host, mongo_port) as db:
-        for change in yapga.db.all_changes(db):
+        for change in yapga.db.all_changes(db, yapga.db.MESSAGE_FIELDS):
             for msg in change.messages:
                 print(msg)
 
@@ -126,55 +151,50 @@ def compare_reviewers(dbname,
                       mongo_host=yapga.db.DEFAULT_MONGO_HOST,
                       mongo_port=yapga.db.DEFAULT_MONGO_PORT,
                       filter_rate=0.0,
-                      outfile=None):
+                      outfile=None,
+                      cache_dir=yapga.util.DEFAULT_CACHE_DIR,
+                      use_snapshot=False,
+                      use_graph=False):
     """Heatmap showing how often reviewers review change owners.
+
+    The counting is done on the server with aggregation pipelines,
+    unless `use_snapshot` is set (or the server can't do it.) With
+    `use_graph` the counts are read from a `yapga.graph.ReviewGraph`
+    of the database instead.
     """
     import math
     import matplotlib.pyplot as plt
+    import yapga.graph
+    import yapga.snapshot
 
     filter_rate = float(filter_rate)
 
     # http://stackoverflow.com/questions/14391959/heatmap-in-matplotlib-with-pcolor
 
     with yapga.db.get_db(dbname, mongo_host, mongo_port) as db:
-        reviews = dict(yapga.db.all_reviewers(db))
-        changes = list(yapga.db.all_changes(db))
-
-    owners = collections.defaultdict(lambda: 0)
-    for change in changes:
-        owners[change.owner.name] += 1
-
-    owners = list(sorted(
-        # Extract just the names from ...
-        x[0] for x in
-
-        # ...the first N (i.e. the people with the most
-        # changes) of...
-        itertools.islice(
-
-            # ...owners dict sorted by number of changes.
-            sorted(owners.items(),
-                   key=lambda x: x[1],
-                   reverse=True),
-            math.ceil((1 - filter_rate) * len(owners)))))
-
-    reviewers = collections.defaultdict(lambda: 0)
-    for revs in reviews.values():
-        for r in revs:
-            reviewers[r.name] += 1
-
-    reviewers = list(sorted(
-        x[0] for x in
-        itertools.islice(
-            sorted(reviewers.items(),
-                   key=lambda x: x[1],
-                   reverse=True),
-            math.ceil((1 - filter_rate) * len(reviewers)))))
-
-    #owners = list(sorted(set(
-    #    c.owner.name for c in changes)))
-    #reviewers = list(sorted(set(
-    #    r.name for revs in reviews.values() for r in revs)))
+        results = None
+        if use_graph:
+            graph = yapga.graph.build(db)
+            results = [graph.owner_counts(),
+                       graph.reviewer_counts(),
+                       graph.pair_counts()]
+        elif not use_snapshot:
+            results = _aggregate(db,
+                                 yapga.db.owner_change_counts,
+                                 yapga.db.reviewer_counts,
+                                 yapga.db.reviewer_owner_counts)
+
+        if results is None:
+            snapshot = yapga.snapshot.load(db, cache_dir)
+            results = [snapshot.counts(snapshot.owner),
+                       snapshot.counts(snapshot.reviewer),
+                       snapshot.reviewer_owner_counts()]
+
+    owner_counts, reviewer_counts, pair_counts = results
+
+    # The owners and reviewers with the most changes and reviews.
+    owners = yapga.graph.most_common(owner_counts, 1 - filter_rate)
+    reviewers = yapga.graph.most_common(reviewer_counts, 1 - filter_rate)
 
     if not owners:
         print('Owners list is empty. Aborting.')
@@ -186,21 +206,7 @@ def compare_reviewers(dbname,
 
     # This is a matrix of reviewer to owner, where each cell is a
     # count of how many times a reviewer reviewed a particular owner
-    data = np.zeros((len(reviewers), len(owners)))
-
-    for change in changes:
-        try:
-            owner_idx = yapga.util.index_of(owners, change.owner.name)
-
-            for reviewer in reviews.get(change.change_id, []):
-                try:
-                    reviewer_idx = yapga.util.index_of(reviewers, reviewer.name)
-                    data[(reviewer_idx, owner_idx)] += 1
-                except ValueError:
-                    pass
-
-        except ValueError:
-            pass
+    data = yapga.graph.pair_matrix(pair_counts, reviewers, owners)
 
     fig = plt.figure()
     ax = fig.add_subplot(111)
@@ -226,25 +232,87 @@ def compare_reviewers(dbname,
     plt.show()
 
 
+@baker.command
+def review_partners(dbname,
+                    account,
+                    mongo_host=yapga.db.DEFAULT_MONGO_HOST,
+                    mongo_port=yapga.db.DEFAULT_MONGO_PORT,
+                    count=10):
+    """Show the `count` people who review the changes of `account`
+    the most, the `count` people whose changes it reviews the most,
+    and how reciprocal its reviewing is.
+
+    `account` is an account id, or the name of an account without one.
+    """
+    import yapga.graph
+
+    try:
+        key = int(account)
+    except ValueError:
+        key = ('name', account)
+
+    with yapga.db.get_db(dbname, mongo_host, mongo_port) as db:
+        graph = yapga.graph.build(db)
+
+    if key not in graph.nodes:
+        print('No account {} in {}'.format(account, dbname))
+        return
+
+    def describe(key):
+        node = graph.nodes[key]
+        if graph.ids[node] < 0:
+            return graph.names[node]
+        return '{} ({})'.format(graph.names[node], graph.ids[node])
+
+    def show(title, pairs):
+        print(title)
+        for other, n in pairs:
+            print('  {:6} {}'.format(n, describe(other)))
+
+    print(describe(key))
+    show('Reviewed by:', graph.top_reviewers(key, count))
+    show('Reviews changes of:', graph.top_owners(key, count))
+    print('Reciprocity: {:.2f}'.format(graph.reciprocity(key)))
+
+
 @baker.command
 def changes_vs_messages(dbname,
                         mongo_host=yapga.db.DEFAULT_MONGO_HOST,
-                        mongo_port=yapga.db.DEFAULT_MONGO_PORT):
+                        mongo_port=yapga.db.DEFAULT_MONGO_PORT,
+                        cache_dir=yapga.util.DEFAULT_CACHE_DIR,
+                        use_snapshot=False):
     """Scatter of #changes vs. #messages for a given user.
+
+    The counting is done on the server with aggregation pipelines,
+    unless `use_snapshot` is set (or the server can't do it.)
     """
+    import numpy as np
+    import yapga.snapshot
 
     with yapga.db.get_db(dbname, mongo_host, mongo_port) as db:
-        changes = list(yapga.db.all_changes(db))
-
-    data = collections.defaultdict(lambda: [0, 0])
-    for change in changes:
-        data[change.owner.name][0] += 1
-        for message in change.messages:
-            if message.author is not None:
-                data[message.author.name][1] += 1
-            else:
-                log.info('No author information for message {}'.format(
-                    message.id))
+        results = None
+        if not use_snapshot:
+            results = _aggregate(db,
+                                 yapga.db.owner_change_counts,
+                                 yapga.db.message_author_counts)
+
+        if results is None:
+            snapshot = yapga.snapshot.load(db, cache_dir)
+            no_author = int(np.sum(snapshot.message_author < 0))
+            if no_author:
+                log.info('No author information for {} messages'.format(
+                    no_author))
+
+            results = [snapshot.counts(snapshot.owner),
+                       snapshot.counts(snapshot.message_author)]
+
+    owner_counts, author_counts = results
+
+    data = collections.OrderedDict()
+    for name, count in owner_counts:
+        data.setdefault(name, [0, 0])[0] = count
+    for name, count in author_counts:
+        data.setdefault(name, [0, 0])[1] = count
 
     # Turn the data into a list of users, change counts, and review
     # counts
@@ -276,3 +344,39 @@ def changes_vs_messages(dbname,
     fig.canvas.mpl_connect('pick_event', onpick)
 
     plt.show()
+
+
+@baker.command
+def explain(dbname,
+            mongo_host=yapga.db.DEFAULT_MONGO_HOST,
+            mongo_port=yapga.db.DEFAULT_MONGO_PORT):
+    """Show the plan the server uses for each query and aggregation
+    made by the analysis commands.
+    """
+    import yapga.snapshot
+
+    queries = [
+        ('list_changes', 'changes', None, None, None),
+        ('list_messages, word_count, random_message',
+         'changes', None, yapga.db.MESSAGE_FIELDS, None),
+        ('snapshot (changes)',
+         'changes', None, yapga.snapshot.CHANGE_FIELDS, None),
+        ('snapshot (reviews)',
+         'reviews', None,
+         ['change_id'] + ['reviewers.' + f
+                          for f in yapga.snapshot.REVIEWER_FIELDS],
+         None),
+        ('snapshot (cache check)',
+         'changes', None, ['updated'], [('updated', -1)]),
+        ('get_reviewers', 'reviews', {'change_id': ''}, None, None),
+        ('insert_change', 'changes', {'change_id': ''}, None, None),
+    ]
+
+    with yapga.db.get_db(dbname, mongo_host, mongo_port) as db:
+        for name, coll, query, fields, sort in queries:
+            print('{}: {}'.format(
+                name, yapga.db.explain_find(db, coll, query, fields, sort)))
+
+        for name in sorted(yapga.db.PIPELINES):
+            print('{}: {}'.format(
+                name, yapga.db.explain_aggregate(db, name)))
@@ -0,0 +1,44 @@
+import logging
+
+import baker
+
+import yapga.analysis
+import yapga.db
+
+
+log = logging.getLogger('yapga')
+
+
+@baker.command
+def report(dbname,
+           mongo_host=yapga.db.DEFAULT_MONGO_HOST,
+           mongo_port=yapga.db.DEFAULT_MONGO_PORT,
+           metrics=None,
+           count=20,
+           batch_size=1000):
+    """Print several metrics of the changes in `dbname`, computed in a
+    single pass over them.
+
+    `metrics` is a comma-separated list of metric names (all of them by
+    default.) `count` is the number of words shown by word_count.
+    """
+    names = None
+    if metrics:
+        names = [m.strip() for m in metrics.split(',')]
+        unknown = [n for n in names if n not in yapga.analysis.METRICS]
+        if unknown:
+            print('Unknown metrics: {}. Choose from: {}'.format(
+                ', '.join(unknown), ', '.join(yapga.analysis.METRICS)))
+            return
+
+    metrics = yapga.analysis.create(names, count=count)
+
+    with yapga.db.get_db(dbname, mongo_host, mongo_port) as db:
+        changes = yapga.analysis.run(db, metrics, int(batch_size))
+
+    log.info('Read {} changes'.format(changes))
+
+    for m in metrics:
+        print('==== {} ===='.format(m.name))
+        m.show()
+        print('')
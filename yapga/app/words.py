@@ -1,97 +1,84 @@
 import collections
+import concurrent.futures
+import heapq
 import itertools
-import re
+import logging
+import multiprocessing
+import operator
 
 import baker
-from nltk.corpus import stopwords
 
 import yapga.db
+import yapga.util
+import yapga.words
 
 
-skip_words = set(itertools.chain(
-    map(str.upper,
-        [
-            'Patch',
-            'Set',
-            'the',
-            'a',
-            'an',
-            'to',
-            'Code-Review+1',
-            'Code-Review+2',
-            'Code-Review-1',
-            'Code-Review-2',
-            'Verified+1',
-            'Verfied',
-        ]),
-    list(map(''.join,
-             itertools.product(map(str, range(10)),
-                               ':.'))),
-    stopwords.words('english')))
-
-skip_res = [
-    'Uploaded patch set \d+.',
-    'Change has been successfully merged into the git repository.',
-    'Change \d+ has been successfully merged into the.*',
-    '.*Looks good to me.*',
-]
-
-trim_res = [
-    r"Patch Set \d+: (.*)",
-    r'(.*)\(\d+ inline comments?\)(.*)',
-]
-
-trim_res = [re.compile(patt, flags=re.DOTALL)
-            for patt in trim_res]
-
-def filter_messages(messages):
-    for msg in messages:
-        if any(re.match(patt, msg) for patt in skip_res):
-            continue
-
-        for patt in trim_res:
-            match = re.search(patt, msg)
-            if match:
-                # print('PATTERN:  ', patt)
-                # print('ORIGINAL: ', msg)
-                msg = ' '.join(match.groups())
-                # print('MODIFIED: ', msg)
-                # print('------------')
-
-        yield msg
-
-def filter_words(words):
-    return filter(lambda x: x.upper() not in skip_words, words)
+log = logging.getLogger('yapga')
+
 
 @baker.command
 def word_count(dbname,
                mongo_host=yapga.db.DEFAULT_MONGO_HOST,
                mongo_port=yapga.db.DEFAULT_MONGO_PORT,
-               count=20):
-    with yapga.db.get_db(dbname, mongo_host, mongo_port) as db:
-        changes = list(yapga.db.all_changes(db))
-
-    word_counts = collections.defaultdict(lambda: 0)
-    messages = filter_messages(m.message
-                               for c in changes
-                               for m in c.messages)
+               count=20,
+               jobs=1,
+               chunk_size=10000,
+               batch_size=1000):
+    """Print the `count` most common words in the review messages in
+    `dbname`.
+
+    Messages are streamed from the database `batch_size` changes at a
+    time and counted in chunks of `chunk_size` messages. With `jobs`
+    greater than one, chunks are counted in that many processes, with
+    at most two chunks per process in flight at once.
+    """
+    word_counts = collections.Counter()
 
-    for word in filter_words(w for m in messages
-                             for w in m.split()):
-        word_counts[word] += 1
-
-    words = sorted(word_counts.items(), key=lambda x: x[1])
-    count = min(count, len(words))
+    with yapga.db.get_db(dbname, mongo_host, mongo_port) as db:
+        messages = (m.message
+                    for c in yapga.db.all_changes(
+                        db, yapga.db.MESSAGE_FIELDS, batch_size)
+                    for m in c.messages)
+        chunks = (list(c) for c in yapga.util.chunks(messages, chunk_size))
+        chunks = itertools.takewhile(bool, chunks)
+
+        if jobs > 1:
+            # Workers are started from a clean server process (or
+            # spawned where there's no forkserver, as on Windows)
+            # rather than forked from this one, which holds the open
+            # database connection and its threads.
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+            else:
+                context = multiprocessing.get_context('spawn')
+            pool = concurrent.futures.ProcessPoolExecutor(
+                jobs, mp_context=context)
+            with pool:
+                pending = collections.deque()
+                for chunk in chunks:
+                    pending.append(
+                        pool.submit(yapga.words.count_words, chunk))
+                    while len(pending) >= 2 * jobs:
+                        word_counts.update(pending.popleft().result())
+
+                while pending:
+                    word_counts.update(pending.popleft().result())
+        else:
+            for chunk in chunks:
+                word_counts.update(yapga.words.count_words(chunk))
+
+    top = heapq.nlargest(count, word_counts.items(),
+                         key=operator.itemgetter(1))
 
     # import matplotlib.pyplot as plt
-    # plt.bar(range(count),
-    #         [w[1] for w in words[-count:]])
-    # plt.xticks(range(count),
-    #            [w[0] for w in words[-count:]],
+    # plt.bar(range(len(top)),
+    #         [w[1] for w in reversed(top)])
+    # plt.xticks(range(len(top)),
+    #            [w[0] for w in reversed(top)],
     #            rotation='vertical')
     # plt.show()
 
-    for word, count in sorted(word_counts.items(), key=lambda x: x[1]):
+    for word, count in reversed(top):
         print(count // 1000 * '*', count, word)
         # print(count, '\t', word)
 
@@ -104,9 +91,10 @@ def random_message(dbname,
     import nltk
 
     with yapga.db.get_db(dbname, mongo_host, mongo_port) as db:
-        messages = filter_messages(m.message
-                                   for c in yapga.db.all_changes(db)
-                                   for m in c.messages)
+        messages = yapga.words.filter_messages(
+            m.message
+            for c in yapga.db.all_changes(db, yapga.db.MESSAGE_FIELDS)
+            for m in c.messages)
     text = nltk.Text(map(nltk.word_tokenize, messages))
     # text = nltk.Text([nltk.word_tokenize(msg) for msg in messages])
     text.generate(100)
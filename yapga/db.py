@@ -1,70 +1,579 @@
-import collections
+import atexit
+import collections.abc
 import contextlib
+import datetime
+import functools
+import logging
+import threading
+import time
 
 import pymongo
+import pymongo.errors
 
 from yapga.gerrit_api import Change, Reviewer
 
 DEFAULT_MONGO_HOST = 'localhost'
 DEFAULT_MONGO_PORT = 27017
 
+# Storage backends
+# ----------------
+#
+# Everything below which takes a `db` works on the MongoDB databases
+# returned by `get_db`. The functions decorated with
+# `functools.singledispatch` form the storage interface: another
+# backend provides its own database class and registers
+# implementations of them for it (see `yapga.sqlite_db`.)
+
+# The fields of a change needed to read its `messages`.
+MESSAGE_FIELDS = ['messages.date', 'messages.message']
+
+log = logging.getLogger('yapga')
+
+# The stored change statuses matched by each `status:` query.
+QUERY_STATUSES = {
+    'open': ['NEW', 'DRAFT'],
+    'pending': ['NEW', 'DRAFT'],
+    'new': ['NEW'],
+    'draft': ['DRAFT'],
+    'merged': ['MERGED'],
+    'abandoned': ['ABANDONED'],
+    'closed': ['MERGED', 'ABANDONED'],
+}
+
+# The indexes created by `ensure_indexes`, as `(collection, keys,
+# options)` tuples.
+INDEXES = [
+    ('changes', [('change_id', pymongo.ASCENDING)], {'unique': True}),
+    ('reviews', [('change_id', pymongo.ASCENDING)], {'unique': True}),
+    ('changes', [('owner._account_id', pymongo.ASCENDING)], {}),
+    ('changes', [('updated', pymongo.DESCENDING)], {}),
+    ('changes', [('project', pymongo.ASCENDING)], {}),
+    ('changes', [('status', pymongo.ASCENDING)], {}),
+]
+
+
+def _walk_mappings(s, visit):
+    """Call `visit` on every mapping nested anywhere in `s`, including
+    inside lists, without recursion. `visit` may rewrite the keys of
+    the mapping it's given, but not its values.
+    """
+    stack = [s]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, dict):
+            visit(obj)
+            values = obj.values()
+        elif isinstance(obj, list):
+            values = obj
+        else:
+            continue
+
+        for v in values:
+            if isinstance(v, (dict, list)):
+                stack.append(v)
+
+
+def _escape_keys(d):
+    # Most mappings have nothing to escape, so leave them untouched.
+    for k in d:
+        if '.' in k or '$' in k:
+            break
+    else:
+        return
+
+    # Rebuild the mapping to keep its key order.
+    items = list(d.items())
+    d.clear()
+    for k, v in items:
+        if '.' in k or '$' in k:
+            k = k.replace('.', '<DOT>').replace('$', '<DOLLAR_SIGN>')
+        d[k] = v
+
+
+def _unescape_keys(d):
+    for k in d:
+        if '<' in k:
+            break
+    else:
+        return
+
+    items = list(d.items())
+    d.clear()
+    for k, v in items:
+        if '<' in k:
+            k = k.replace('<DOT>', '.').replace('<DOLLAR_SIGN>', '$')
+        d[k] = v
+
 
 def escape_struct(s):
-    if not isinstance(s, collections.abc.Mapping):
-        return s
+    """Escape (in place) the characters MongoDB doesn't allow in keys
+    ('.' and '$') throughout `s`. Returns `s`.
+    """
+    _walk_mappings(s, _escape_keys)
+    return s
 
-    for k, v in list(s.items()):
-        del s[k]
-        s[k.replace('.', '<DOT>').replace('$', '<DOLLAR_SIGN>')] = escape_struct(v)
 
+def unescape_struct(s):
+    """Undo `escape_struct` (in place) throughout `s`. Returns `s`.
+    """
+    _walk_mappings(s, _unescape_keys)
     return s
 
 
+# Clients shared by everything in this process, keyed by host, port
+# and options. See `get_client`.
+_clients = {}
+_indexed = set()
+_clients_lock = threading.Lock()
+
+
+def get_client(mongo_host=DEFAULT_MONGO_HOST,
+               mongo_port=DEFAULT_MONGO_PORT,
+               **options):
+    """Get the process-wide `MongoClient` for `mongo_host` and
+    `mongo_port`, creating it on first use.
+
+    `options` are passed to `MongoClient` (e.g. `maxPoolSize`,
+    `serverSelectionTimeoutMS` or `socketTimeoutMS`), and clients with
+    different options are kept separately. Clients are closed by
+    `close_clients`, which is called at exit.
+    """
+    key = (mongo_host, int(mongo_port), tuple(sorted(options.items())))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = pymongo.MongoClient(
+                mongo_host, int(mongo_port), **options)
+        return client
+
+
+def close_clients():
+    """Close all of the clients created by `get_client`."""
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+        _indexed.clear()
+
+    for client in clients:
+        client.close()
+
+
+atexit.register(close_clients)
+
+
 @contextlib.contextmanager
 def get_db(dbname,
            mongo_host=DEFAULT_MONGO_HOST,
-           mongo_port=DEFAULT_MONGO_PORT):
-    client = pymongo.MongoClient(mongo_host,
-                                 int(mongo_port))
-    yield client[dbname]
+           mongo_port=DEFAULT_MONGO_PORT,
+           **client_options):
+    """Get the database `dbname` using the shared client from
+    `get_client`, making sure its indexes exist the first time.
+
+    If `dbname` is of the form 'sqlite:PATH', the SQLite database
+    file PATH is used instead (see `yapga.sqlite_db`.)
+    """
+    if dbname.startswith('sqlite:'):
+        import yapga.sqlite_db
+        db = yapga.sqlite_db.SQLiteDatabase(yapga.sqlite_db.path(dbname))
+        try:
+            yield db
+        finally:
+            db.close()
+        return
 
+    client = get_client(mongo_host, mongo_port, **client_options)
+    db = client[dbname]
 
+    key = (id(client), dbname)
+    if key not in _indexed:
+        ensure_indexes(db)
+        _indexed.add(key)
+
+    yield db
+
+
+def ensure_indexes(db):
+    """Create the indexes in `INDEXES` in `db` if they don't exist.
+
+    Failures (e.g. a unique index over existing duplicates, or a
+    read-only user) are logged rather than raised.
+    """
+    for coll, keys, options in INDEXES:
+        try:
+            db[coll].create_index(keys, **options)
+        except pymongo.errors.OperationFailure:
+            log.warning('Unable to create index {} on {}'.format(
+                keys, coll), exc_info=True)
+
+
+def _plan_summary(plan):
+    """Summarize a query plan from `explain` as a chain of stages,
+    e.g. 'PROJECTION_SIMPLE <- FETCH <- IXSCAN(change_id_1)'.
+    """
+    plan = plan.get('queryPlan', plan)
+    stage = plan.get('stage', '?')
+    if 'indexName' in plan:
+        stage += '({})'.format(plan['indexName'])
+
+    if 'inputStage' in plan:
+        return '{} <- {}'.format(stage, _plan_summary(plan['inputStage']))
+    if 'inputStages' in plan:
+        return '{} <- [{}]'.format(
+            stage, ', '.join(_plan_summary(p) for p in plan['inputStages']))
+    return stage
+
+
+def _find_plans(explained):
+    """Find the winning plans anywhere in the output of an `explain`."""
+    if isinstance(explained, collections.abc.Mapping):
+        if 'winningPlan' in explained:
+            yield explained['winningPlan']
+        for v in explained.values():
+            yield from _find_plans(v)
+    elif isinstance(explained, list):
+        for v in explained:
+            yield from _find_plans(v)
+
+
+@functools.singledispatch
+def explain_find(db, coll, query=None, fields=None, sort=None):
+    """Describe the plan the server would use for a `find` on `coll`.
+    """
+    cursor = db[coll].find(query or {}, projection=_projection(fields))
+    if sort is not None:
+        cursor = cursor.sort(sort)
+    return '; '.join(_plan_summary(p) for p in _find_plans(cursor.explain()))
+
+
+@functools.singledispatch
+def explain_aggregate(db, name):
+    """Describe the plan the server would use for the aggregation
+    `name` in `PIPELINES`.
+    """
+    coll, pipeline = PIPELINES[name]
+    explained = db.command('aggregate', coll,
+                           pipeline=pipeline, explain=True)
+    stages = ' | '.join(next(iter(s)) for s in pipeline)
+    plans = '; '.join(_plan_summary(p) for p in _find_plans(explained))
+    return '{} [{}]'.format(plans, stages)
+
+
+def _collection(db, name, write_concern=None):
+    """Get the collection `name` from `db`, using `write_concern` (a
+    `w` value like 1, 0 or 'majority') for writes if it's not None.
+    """
+    coll = db[name]
+    if write_concern is None:
+        return coll
+
+    if isinstance(write_concern, str) and write_concern.isdigit():
+        write_concern = int(write_concern)
+    return coll.with_options(
+        write_concern=pymongo.WriteConcern(w=write_concern))
+
+
+def _bulk_write(coll, ops, kind):
+    if not ops:
+        return 0
+
+    start = time.perf_counter()
+    coll.bulk_write(ops, ordered=False)
+    elapsed = time.perf_counter() - start
+    log.info('Wrote {} {} in {:.2f}s ({:.0f}/s)'.format(
+        len(ops), kind, elapsed, len(ops) / elapsed if elapsed else 0))
+    return len(ops)
+
+
+@functools.singledispatch
 def insert_change(db, change):
     change_coll = db['changes']
-    change_coll.update({'change_id': change['change_id']},
-                       escape_struct(change),
-                       upsert=True)
+    change_coll.replace_one({'change_id': change['change_id']},
+                            escape_struct(change),
+                            upsert=True)
+
+
+@functools.singledispatch
+def insert_changes(db, changes, write_concern=None):
+    """Upsert a batch of `changes` with a single unordered bulk write.
+
+    Returns the number of changes written.
+    """
+    ops = [pymongo.ReplaceOne({'change_id': c['change_id']},
+                              escape_struct(c),
+                              upsert=True)
+           for c in changes]
+    return _bulk_write(_collection(db, 'changes', write_concern),
+                       ops, 'changes')
 
 
+@functools.singledispatch
 def insert_reviewers(db, change_id, reviewers, upsert=True):
     rev_coll = db['reviews']
-    rev_coll.update({'change_id': change_id},
-                    {'change_id': change_id,
-                     'reviewers': escape_struct(reviewers)},
-                    upsert=upsert)
+    rev_coll.replace_one({'change_id': change_id},
+                         {'change_id': change_id,
+                          'reviewers': escape_struct(reviewers)},
+                         upsert=upsert)
 
 
-def all_changes(db):
+@functools.singledispatch
+def insert_reviews(db, reviews, write_concern=None):
+    """Upsert a batch of `(change-id, reviewers)` pairs with a single
+    unordered bulk write.
+
+    Returns the number of reviews written.
+    """
+    ops = [pymongo.ReplaceOne({'change_id': change_id},
+                              {'change_id': change_id,
+                               'reviewers': escape_struct(reviewers)},
+                              upsert=True)
+           for change_id, reviewers in reviews]
+    return _bulk_write(_collection(db, 'reviews', write_concern),
+                       ops, 'reviews')
+
+
+def _projection(fields):
+    if fields is None:
+        return None
+    projection = {f: 1 for f in fields}
+    projection.setdefault('_id', 0)
+    return projection
+
+
+@functools.singledispatch
+def all_changes(db, fields=None, batch_size=None):
     """Read changes from `dbname` and generate a sequence of `Change`
     objects.
+
+    If `fields` is given, only those fields (in dotted notation, e.g.
+    'owner.name') are fetched from the server. `batch_size` sets the
+    number of documents fetched per round trip.
     """
     changes = db['changes']
 
-    for c in changes.find():
-        yield Change(c)
+    cursor = changes.find(projection=_projection(fields))
+    if batch_size is not None:
+        cursor = cursor.batch_size(batch_size)
+
+    for c in cursor:
+        yield Change(unescape_struct(c))
 
 
-def all_reviewers(db):
+@functools.singledispatch
+def all_reviewers(db, fields=None, batch_size=None):
     """Read reviews from `dbname` and generates a sequence of
     `(change-id, [Reviewer, . . .])` tuples.
+
+    `fields` (relative to each reviewer, e.g. 'name') and `batch_size`
+    are as for `all_changes`.
     """
 
     reviews = db['reviews']
 
-    for rev in reviews.find():
-        yield (rev['change_id'], [Reviewer(r) for r in rev['reviewers']])
+    if fields is not None:
+        fields = ['change_id'] + ['reviewers.{}'.format(f) for f in fields]
+
+    cursor = reviews.find(projection=_projection(fields))
+    if batch_size is not None:
+        cursor = cursor.batch_size(batch_size)
+
+    for rev in cursor:
+        yield (rev['change_id'],
+               [Reviewer(r) for r in unescape_struct(rev['reviewers'])])
+
+
+def _count_by_name(name_field):
+    """Pipeline stages counting documents by `name_field`, with
+    missing names counted as 'UNKNOWN' (as `Account.name` does.)
+
+    The documents must come in `_id` order, with the position of any
+    unwound array element in `index`, so that the names can be sorted
+    in the order they're first seen.
+    """
+    return [{'$group': {'_id': {'$ifNull': [name_field, 'UNKNOWN']},
+                        'count': {'$sum': 1},
+                        'first': {'$first': '$_id'},
+                        'index': {'$first': '$index'}}},
+            {'$sort': {'first': 1, 'index': 1}}]
+
+
+# The aggregations run by this module, as `(collection, pipeline)`
+# pairs.
+PIPELINES = {
+    'changes_missing_reviewers': ('changes', [
+        {'$project': {'_id': 0, 'change_id': 1}},
+        {'$lookup': {'from': 'reviews',
+                     'localField': 'change_id',
+                     'foreignField': 'change_id',
+                     'as': 'reviews'}},
+        {'$match': {'reviews': {'$size': 0}}},
+    ]),
+
+    'owner_change_counts': ('changes', [
+        {'$sort': {'_id': 1}},
+    ] + _count_by_name('$owner.name')),
+
+    'message_author_counts': ('changes', [
+        {'$sort': {'_id': 1}},
+        {'$project': {'messages.author.name': 1}},
+        {'$unwind': {'path': '$messages', 'includeArrayIndex': 'index'}},
+        {'$match': {'messages.author': {'$exists': True}}},
+    ] + _count_by_name('$messages.author.name')),
+
+    'reviewer_counts': ('reviews', [
+        {'$sort': {'_id': 1}},
+        {'$project': {'reviewers.name': 1}},
+        {'$unwind': {'path': '$reviewers', 'includeArrayIndex': 'index'}},
+    ] + _count_by_name('$reviewers.name')),
+
+    'reviewer_owner_counts': ('reviews', [
+        {'$project': {'_id': 0, 'change_id': 1, 'reviewers.name': 1}},
+        {'$lookup': {'from': 'changes',
+                     'localField': 'change_id',
+                     'foreignField': 'change_id',
+                     'as': 'change'}},
+        {'$unwind': '$change'},
+        {'$unwind': '$reviewers'},
+        {'$group': {
+            '_id': {
+                'reviewer': {'$ifNull': ['$reviewers.name', 'UNKNOWN']},
+                'owner': {'$ifNull': ['$change.owner.name', 'UNKNOWN']}},
+            'count': {'$sum': 1}}},
+    ]),
+}
+
+
+def _aggregate(db, name):
+    coll, pipeline = PIPELINES[name]
+    return db[coll].aggregate(pipeline, allowDiskUse=True)
+
+
+@functools.singledispatch
+def owner_change_counts(db):
+    """Count the changes owned by each owner name in `db` on the
+    server. Generates `(name, count)` pairs in the order the names
+    are first seen.
+    """
+    for r in _aggregate(db, 'owner_change_counts'):
+        yield (r['_id'], r['count'])
+
+
+@functools.singledispatch
+def message_author_counts(db):
+    """Count the messages written by each author name in `db` on the
+    server, ignoring messages without an author. Generates `(name,
+    count)` pairs in the order the names are first seen.
+    """
+    for r in _aggregate(db, 'message_author_counts'):
+        yield (r['_id'], r['count'])
+
 
+@functools.singledispatch
+def reviewer_counts(db):
+    """Count the reviews done by each reviewer name in `db` on the
+    server. Generates `(name, count)` pairs in the order the names
+    are first seen.
+    """
+    for r in _aggregate(db, 'reviewer_counts'):
+        yield (r['_id'], r['count'])
+
+
+@functools.singledispatch
+def reviewer_owner_counts(db):
+    """Count how often each reviewer name reviewed changes of each
+    owner name in `db` on the server. Generates `((reviewer, owner),
+    count)` pairs.
+    """
+    for r in _aggregate(db, 'reviewer_owner_counts'):
+        yield ((r['_id']['reviewer'], r['_id']['owner']), r['count'])
+
+
+@functools.singledispatch
+def get_high_water_mark(db, server, status):
+    """Get the newest `updated` timestamp fetched from `server` by an
+    incremental fetch of changes with `status`, or None if there's
+    none.
+
+    If no incremental fetch has been recorded, the newest change in
+    `db` with that status is used (assuming `db` only holds changes
+    from `server`.) There's no fallback for statuses not in
+    `QUERY_STATUSES`.
+    """
+    state = db['sync_state'].find_one({'server': server, 'status': status})
+    if state is not None:
+        return state['updated']
+
+    if status not in QUERY_STATUSES:
+        return None
+
+    newest = db['changes'].find_one(
+        {'status': {'$in': QUERY_STATUSES[status]}},
+        projection={'updated': 1},
+        sort=[('updated', pymongo.DESCENDING)])
+    if newest is not None:
+        return newest.get('updated')
+
+    return None
+
+
+@functools.singledispatch
+def set_high_water_mark(db, server, status, updated):
+    """Record `updated` as the newest timestamp fetched from `server`
+    for changes with `status`, unless a newer one is already recorded.
+    """
+    db['sync_state'].update_one({'server': server, 'status': status},
+                                {'$max': {'updated': updated}},
+                                upsert=True)
+
+
+@functools.singledispatch
+def get_crawl_state(db, crawl):
+    """Get the last checkpoint saved for `crawl`, or None."""
+    return db['crawl_state'].find_one({'_id': crawl})
+
+
+@functools.singledispatch
+def save_crawl_state(db, crawl, **state):
+    """Checkpoint the progress of `crawl` in the `crawl_state`
+    collection.
+    """
+    state['saved_at'] = datetime.datetime.utcnow()
+    db['crawl_state'].replace_one({'_id': crawl}, state, upsert=True)
+
+
+@functools.singledispatch
+def changes_missing_reviewers(db):
+    """Generate the change-ids of all changes in `db` which have no
+    entry in the `reviews` collection.
+    """
+    for c in _aggregate(db, 'changes_missing_reviewers'):
+        yield c['change_id']
+
+
+@functools.singledispatch
 def get_reviewers(db, change_id):
     rev_coll = db['reviews']
     for r in rev_coll.find({'change_id': change_id}):
         yield r
+
+
+@functools.singledispatch
+def content_state(db):
+    """Describe the contents of `db` well enough to notice when they
+    change: the document counts and the newest `updated` timestamp.
+    """
+    newest = db['changes'].find_one(projection={'_id': 0, 'updated': 1},
+                                    sort=[('updated', pymongo.DESCENDING)])
+    return {
+        'changes': db['changes'].count_documents({}),
+        'reviews': db['reviews'].count_documents({}),
+        'updated': newest.get('updated') if newest else None,
+    }
+
+
+@functools.singledispatch
+def db_key(db):
+    """A name for `db` which is unique on this machine and usable as a
+    file name.
+    """
+    host, port = db.client.address
+    return '{}_{}_{}'.format(host, port, db.name)
@@ -0,0 +1,189 @@
+import collections
+import concurrent.futures
+import itertools
+import logging
+import urllib.parse
+
+import yapga.db
+import yapga.gerrit_api
+import yapga.util
+
+
+log = logging.getLogger('yapga')
+
+
+def fetch(db, conn, url,
+          count=None,
+          batch_size=500,
+          start_at=None,
+          status='merged',
+          workers=1,
+          write_concern=None,
+          stream=False,
+          incremental=False,
+          resume=False,
+          retries=3):
+    """Fetch up to `count` changes with `status` from the gerrit server
+    at `url`, through the `Connection` `conn`, into `db` in batches of
+    `batch_size`. The other arguments are as for the `fetch` command.
+
+    Returns True if the crawl finished, or False if it failed part way
+    (leaving a checkpoint to resume from.)
+    """
+    query = 'q=status:{}'.format(status)
+
+    if incremental:
+        since = yapga.db.get_high_water_mark(db, url, status)
+        if since is not None:
+            log.info('Fetching changes updated since {}'.format(since))
+            # Gerrit wants "YYYY-MM-DD hh:mm:ss", without the
+            # nanoseconds in `updated`.
+            query += '+after:{}'.format(
+                urllib.parse.quote('"{}"'.format(since[:19]), safe=':'))
+
+    queries = [query,
+               'o=ALL_REVISIONS',
+               'o=ALL_FILES',
+               'o=ALL_COMMITS',
+               'o=MESSAGES',
+               'n={}'.format(batch_size)]
+
+    crawl = 'fetch:{}:{}'.format(url, status)
+    state = {'sortkey': start_at, 'changes': 0, 'newest': None}
+    if resume:
+        saved = yapga.db.get_crawl_state(db, crawl)
+        if saved is None or saved.get('complete'):
+            log.info('No interrupted crawl to resume.')
+        else:
+            state.update((k, saved[k]) for k in state if k in saved)
+            start_at = state['sortkey']
+            log.info('Resuming after sort key {} ({} changes saved)'.format(
+                start_at, state['changes']))
+
+    if start_at is not None:
+        queries.append('N={}'.format(start_at))
+
+    if count is not None:
+        count = int(count)
+
+    changes = itertools.islice(
+        yapga.gerrit_api.fetch_changes(conn, queries=queries, stream=stream,
+                                       retries=retries),
+        count)
+    if workers > 1:
+        # Limited to `count` first, so nothing past it is fetched.
+        changes = yapga.util.prefetch(changes, batch_size * workers)
+
+    chunks = yapga.util.chunks(changes, batch_size)
+
+    def commit(future, sortkey, newest):
+        saved = future.result()
+        state['sortkey'] = sortkey
+        state['changes'] += saved
+        state['newest'] = max(state['newest'] or '', newest)
+        yapga.db.save_crawl_state(db, crawl, complete=False, **state)
+        log.info('Saved {} changes up to sort key {}'.format(
+            saved, sortkey))
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers) as pool:
+            pending = collections.deque()
+            for chunk in (list(c) for c in chunks):
+                if not chunk:
+                    break
+                pending.append(
+                    (pool.submit(yapga.db.insert_changes,
+                                 db, chunk, write_concern),
+                     chunk[-1].get('_sortkey'),
+                     max(c.get('updated', '') for c in chunk)))
+
+                # Wait for the oldest batch before queueing more than
+                # `workers` of them.
+                while len(pending) >= workers:
+                    commit(*pending.popleft())
+
+            while pending:
+                commit(*pending.popleft())
+
+    except Exception:
+        log.exception(
+            'Error fetching results. Partial results saved '
+            'up to sort key {}. Use --resume to continue.'.format(
+                state['sortkey']))
+        return False
+
+    finally:
+        if workers > 1:
+            # Stops the prefetching thread if we stopped early.
+            changes.close()
+
+    if count is None:
+        yapga.db.save_crawl_state(db, crawl, complete=True, **state)
+
+        # Changes come newest first, so a partial crawl can't move the
+        # high-water mark without leaving a gap behind it.
+        if incremental and state['newest']:
+            yapga.db.set_high_water_mark(db, url, status,
+                                       state['newest'])
+
+    return True
+
+
+def fetch_reviewers(db, conn, url,
+                    workers=1,
+                    rate=0.0,
+                    retries=3,
+                    batch_size=100,
+                    write_concern=None):
+    """Fetch the reviewers of the changes in `db` without any from the
+    gerrit server at `url`, through the `Connection` `conn`. The other
+    arguments are as for the `fetch_reviewers` command.
+
+    Returns the number of changes whose reviewers couldn't be fetched.
+    """
+    limiter = yapga.util.RateLimiter(rate)
+
+    change_ids = list(yapga.db.changes_missing_reviewers(db))
+    log.info('{} changes need reviewers'.format(len(change_ids)))
+
+    crawl = 'fetch_reviewers:{}'.format(url)
+    state = {'reviews': 0, 'remaining': len(change_ids)}
+    yapga.db.save_crawl_state(db, crawl, complete=False, **state)
+
+    def fetch_one(change_id):
+        limiter.wait()
+        try:
+            print('Fetching reviewers for change {}'.format(change_id))
+            return (change_id,
+                    yapga.util.retry(
+                        lambda: yapga.gerrit_api.fetch_reviewers(
+                            conn, change_id),
+                        retries,
+                        transient=yapga.gerrit_api.is_transient))
+        except Exception:
+            log.exception(
+                'Error fetching reviewers for change {}'.format(change_id))
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers) as pool:
+        results = (r for r in pool.map(fetch_one, change_ids)
+                   if r is not None)
+        for batch in (list(c) for c in yapga.util.chunks(results,
+                                                         batch_size)):
+            if not batch:
+                break
+            saved = yapga.db.insert_reviews(db, batch, write_concern)
+            state['reviews'] += saved
+            state['remaining'] -= saved
+            yapga.db.save_crawl_state(db, crawl, complete=False, **state)
+
+    # Changes which failed are still missing reviewers, so a rerun
+    # picks them up.
+    if state['remaining']:
+        log.warning('Reviewers of {} changes could not be fetched. '
+                    'Rerun to retry them.'.format(state['remaining']))
+    yapga.db.save_crawl_state(db, crawl,
+                              complete=state['remaining'] == 0, **state)
+    return state['remaining']
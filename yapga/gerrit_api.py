@@ -1,6 +1,17 @@
+import hashlib
+import http.client
+import io
 import json
 import logging
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
 import urllib.request
+import zlib
+
+import yapga.util
 
 
 logging.basicConfig(level=logging.DEBUG)
@@ -14,22 +25,275 @@ class Connection:
         self.uri = uri
         self.opener = opener
 
-    def req(self, path, queries=None):
+    def _url(self, path, queries):
         url = '{}/{}/'.format(self.uri,
                              '/'.join(path))
         if queries:
             url += '?{}'.format('&'.join(queries))
 
         log.info('request url: {}'.format(url))
+        return url
 
-        req = self.opener.open(url)
+    def req(self, path, queries=None):
+        req = self.opener.open(self._url(path, queries))
         data = req.read()
         data = data[4:]  # strip "magic" anti-XSSI header
         data = data.decode('utf-8')
         return json.loads(data)
 
+    def req_stream(self, path, queries=None):
+        """Like `req`, but for requests returning a JSON list. The
+        elements are parsed and generated one at a time as the
+        response is read.
+        """
+        req = self.opener.open(self._url(path, queries))
+        try:
+            req.read(4)  # skip "magic" anti-XSSI header
+            yield from yapga.util.iter_json_array(req)
+            req.read()  # drain any trailing whitespace
+        finally:
+            req.close()
+
+
+class _DigestAuth:
+    """Client side of HTTP digest authentication (RFC 2617).
+
+    Once a challenge has been seen, its nonce is reused for every
+    following request (with an increasing nonce-count) until the
+    server rejects it, so we don't pay for a 401 round trip on each
+    request.
+    """
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self.challenge = None
+        self.nonce_count = 0
+        self.lock = threading.Lock()
+
+    def set_challenge(self, header):
+        scheme, _, params = header.partition(' ')
+        if scheme.lower() != 'digest':
+            raise ValueError(
+                'Unsupported authentication scheme: {}'.format(scheme))
+
+        challenge = urllib.request.parse_keqv_list(
+            urllib.request.parse_http_list(params))
+        with self.lock:
+            self.challenge = challenge
+            self.nonce_count = 0
+
+    def header(self, method, path):
+        """Get the Authorization header value for a request, or None if
+        we haven't been challenged yet.
+        """
+        with self.lock:
+            if self.challenge is None:
+                return None
+            challenge = self.challenge
+            self.nonce_count += 1
+            nc = '{:08x}'.format(self.nonce_count)
+
+        algorithm = challenge.get('algorithm', 'MD5')
+        hash_name = {'MD5': 'md5', 'SHA-256': 'sha256'}[algorithm.upper()]
+
+        def H(x):
+            return hashlib.new(hash_name, x.encode('utf-8')).hexdigest()
+
+        realm = challenge['realm']
+        nonce = challenge['nonce']
+        ha1 = H('{}:{}:{}'.format(self.username, realm, self.password))
+        ha2 = H('{}:{}'.format(method, path))
+
+        fields = [('username', self.username),
+                  ('realm', realm),
+                  ('nonce', nonce),
+                  ('uri', path)]
+
+        qops = [q.strip() for q in challenge.get('qop', '').split(',')]
+        if 'auth' in qops:
+            cnonce = os.urandom(8).hex()
+            response = H('{}:{}:{}:{}:auth:{}'.format(
+                ha1, nonce, nc, cnonce, ha2))
+            fields += [('qop', 'auth'), ('nc', nc), ('cnonce', cnonce)]
+        else:
+            response = H('{}:{}:{}'.format(ha1, nonce, ha2))
+
+        fields += [('response', response), ('algorithm', algorithm)]
+        if 'opaque' in challenge:
+            fields.append(('opaque', challenge['opaque']))
+
+        return 'Digest ' + ', '.join(
+            # qop, nc and algorithm are tokens; the rest are quoted.
+            '{}={}'.format(k, v) if k in ('qop', 'nc', 'algorithm')
+            else '{}="{}"'.format(k, v)
+            for k, v in fields)
+
+
+class _PooledResponse:
+    """File-like body of a response from a `PooledOpener`.
+
+    The underlying connection is handed back to the pool once the body
+    has been completely read.
+    """
+    def __init__(self, opener, key, conn, resp):
+        self.opener = opener
+        self.key = key
+        self.conn = conn
+        self.resp = resp
+        self.buffer = b''
+        self.decoder = None
+        if resp.getheader('Content-Encoding', '').lower() == 'gzip':
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    @property
+    def status(self):
+        return self.resp.status
+
+    @property
+    def headers(self):
+        return self.resp.headers
+
+    def read(self, amt=-1):
+        if self.decoder is None:
+            data = self.resp.read(None if amt < 0 else amt)
+        else:
+            while not self.resp.isclosed() and (
+                    amt < 0 or len(self.buffer) < amt):
+                raw = self.resp.read(PooledOpener.CHUNK_SIZE)
+                self.buffer += self.decoder.decompress(raw)
+                if not raw:
+                    self.buffer += self.decoder.flush()
+
+            if amt < 0:
+                data, self.buffer = self.buffer, b''
+            else:
+                data, self.buffer = self.buffer[:amt], self.buffer[amt:]
+
+        if self.resp.isclosed() and self.conn is not None:
+            self.opener._release(self.key, self.conn, self.resp.will_close)
+            self.conn = None
+
+        return data
+
+    def close(self):
+        # A connection with an unread body can't be reused.
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PooledOpener:
+    """An alternative to the `urllib.request` openers which keeps
+    persistent HTTP/1.1 connections to each host and reuses them across
+    requests (and threads.)
+
+    If `username` is given, digest authentication is used. If `gzip`
+    is true the server is asked to compress its responses.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, username=None, password=None,
+                 gzip=False, timeout=None):
+        self.auth = None
+        if username is not None:
+            self.auth = _DigestAuth(username, password)
+        self.gzip = gzip
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def _acquire(self, key):
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns:
+                return conns.pop(), True
+
+        scheme, netloc = key
+        conn_class = (http.client.HTTPSConnection if scheme == 'https'
+                      else http.client.HTTPConnection)
+        return conn_class(netloc, timeout=self.timeout), False
+
+    def _release(self, key, conn, will_close):
+        if will_close:
+            conn.close()
+            return
+
+        with self.lock:
+            self.idle.setdefault(key, []).append(conn)
+
+    def close(self):
+        """Close all idle connections."""
+        with self.lock:
+            idle, self.idle = self.idle, {}
+
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def open(self, url):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/',
+                                        parts.query, ''))
+
+        challenged = False
+        while True:
+            conn, reused = self._acquire(key)
+
+            headers = {}
+            if self.gzip:
+                headers['Accept-Encoding'] = 'gzip'
+            if self.auth is not None:
+                auth = self.auth.header('GET', path)
+                if auth is not None:
+                    headers['Authorization'] = auth
+
+            try:
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                # The server may have dropped an idle keep-alive
+                # connection, so try again on a fresh one.
+                if reused:
+                    continue
+                raise
+
+            if resp.status == 401 and self.auth is not None \
+                    and not challenged:
+                resp.read()
+                self._release(key, conn, resp.will_close)
+                self.auth.set_challenge(resp.getheader('WWW-Authenticate'))
+                challenged = True
+                continue
+
+            if resp.status >= 400:
+                body = resp.read()
+                self._release(key, conn, resp.will_close)
+                raise urllib.error.HTTPError(url, resp.status, resp.reason,
+                                             resp.headers, io.BytesIO(body))
+
+            return _PooledResponse(self, key, conn, resp)
+
+
+def create_connection(uri, username=None, password=None,
+                      pooled=False, gzip=False):
+    """Create a `Connection` to the gerrit server at `uri`.
+
+    By default requests go through `urllib.request`. If `pooled` is
+    true, a `PooledOpener` is used instead, which keeps connections
+    alive between requests and optionally asks for gzip compressed
+    responses.
+    """
+    if pooled:
+        return Connection(uri, PooledOpener(username, password, gzip=gzip))
 
-def create_connection(uri, username=None, password=None):
     handlers = []
     if username is not None:
         # Create an auth-handler for our user
@@ -44,9 +308,27 @@ def create_connection(uri, username=None, password=None):
     return Connection(uri, opener)
 
 
-def fetch_changes(conn, queries=None):
+def is_transient(exc):
+    """Is `exc`, raised by a request, likely to go away if the request
+    is retried?
+    """
+    if isinstance(exc, urllib.error.HTTPError):
+        return exc.code in (408, 429, 500, 502, 503, 504)
+    return isinstance(exc, (OSError, http.client.HTTPException))
+
+
+def fetch_changes(conn, queries=None, stream=False,
+                  retries=0, retry_delay=1.0):
     """Generate a sequence of ChangeInfo structs (see: gerrit REST API
     documentation.)
+
+    If `stream` is true, each page is parsed incrementally as it's
+    downloaded rather than being read into memory in full.
+
+    Requests failing with transient errors are retried up to `retries`
+    times in a row, waiting `retry_delay` seconds and doubling the
+    wait each time. The retried request carries on after the last
+    change generated, so none are repeated or skipped.
     """
     if queries is None:
         queries = ['q=status:merged',
@@ -54,23 +336,57 @@ def fetch_changes(conn, queries=None):
                    'o=ALL_FILES',
                    'n=500']
 
-    changes = conn.req(['changes'],
-                       queries=queries)
-    for c in changes:
-        yield c
+    request = conn.req_stream if stream else conn.req
+
+    # Later pages replace any starting sort key in `queries`.
+    page_queries = queries
+    queries = [q for q in queries if not q.startswith('N=')]
+    failures = 0
+    while True:
+        last = None
+        try:
+            for last in request(['changes'], queries=page_queries):
+                yield last
+        except Exception as e:
+            if failures >= retries or not is_transient(e):
+                raise
+
+            delay = retry_delay * 2 ** failures
+            failures += 1
+            log.warning('Request failed ({}). Retrying in {}s.'.format(
+                e, delay))
+            time.sleep(delay)
+
+            if last is not None:
+                page_queries = queries + ['N={}'.format(last['_sortkey'])]
+            continue
+
+        failures = 0
+        if last is None or not last.get('_more_changes', False):
+            return
 
-    while changes[-1].get('_more_changes', False):
-        changes = conn.req(
-            ['changes'],
-            queries=queries + ['N={}'.format(changes[-1]['_sortkey'])])
-        for c in changes:
-            yield c
+        page_queries = queries + ['N={}'.format(last['_sortkey'])]
 
 
 def fetch_reviewers(conn, change_id):
     return conn.req(['changes', change_id, 'reviewers'])
 
+def _field(name):
+    """A property reading the JSON field `name` from `self.data`.
+
+    Known fields are declared with this so that looking them up doesn't
+    first fail the normal attribute lookup and fall back to
+    `__getattr__`.
+    """
+    def get(self):
+        return self.data[name]
+    get.__name__ = name
+    return property(get)
+
+
 class JSONObject:
+    __slots__ = ('data',)
+
     def __init__(self, data):
         self.data = data
 
@@ -79,8 +395,25 @@ class JSONObject:
 
 
 class Change(JSONObject):
-    def __init__(self, data):
-        self.data = data
+    __slots__ = ()
+
+    # The scalar ChangeInfo fields.
+    id = _field('id')
+    project = _field('project')
+    branch = _field('branch')
+    topic = _field('topic')
+    change_id = _field('change_id')
+    subject = _field('subject')
+    status = _field('status')
+    created = _field('created')
+    updated = _field('updated')
+    mergeable = _field('mergeable')
+    insertions = _field('insertions')
+    deletions = _field('deletions')
+    current_revision = _field('current_revision')
+    kind = _field('kind')
+    _sortkey = _field('_sortkey')
+    _number = _field('_number')
 
     @property
     def revisions(self):
@@ -88,12 +421,28 @@ class Change(JSONObject):
         for rev_id, rev_data in revs.items():
             yield Revision(self.id, rev_id, rev_data)
 
+    @property
+    def revision_count(self):
+        return len(self.data.get('revisions', ()))
+
+    @property
+    def first_revision(self):
+        """The first `Revision` in the change, or None if it has none.
+        """
+        for rev_id, rev_data in self.data.get('revisions', {}).items():
+            return Revision(self.id, rev_id, rev_data)
+        return None
+
     @property
     def messages(self):
         msgs = self.data.get('messages', [])
         for msg in msgs:
             yield ChangeMessage(msg)
 
+    @property
+    def message_count(self):
+        return len(self.data.get('messages', ()))
+
     @property
     def owner(self):
         return Account(self.data['owner'])
@@ -106,6 +455,8 @@ class Change(JSONObject):
 
 
 class Account:
+    __slots__ = ('data',)
+
     def __init__(self, data):
         self.data = data
 
@@ -129,6 +480,10 @@ class Account:
     def email(self, email):
         self.data['email'] = email
 
+    @property
+    def username(self):
+        return self.data.get('username', 'UNKNOWN')
+
     def __repr__(self):
         return 'Account(name="{}", email="{}")'.format(
             self.name, self.email)
@@ -138,6 +493,8 @@ class Account:
 
 
 class Reviewer(Account):
+    __slots__ = ()
+
     @property
     def kind(self):
         return self.data.get('kind', 'UNKNOWN')
@@ -148,23 +505,52 @@ class Reviewer(Account):
 
 
 class ChangeMessage:
+    """A message on a change. Its fields are read from `data` when
+    they're used, so the author's `Account` is only built if it's
+    asked for.
+    """
+    __slots__ = ('data',)
+
     def __init__(self, data):
         self.data = data
-        self.id = self.data.get('id', 'UNKNOWN')
 
+    @property
+    def id(self):
+        return self.data.get('id', 'UNKNOWN')
+
+    @property
+    def author(self):
         try:
-            self.author = Account(self.data['author'])
+            return Account(self.data['author'])
         except KeyError:
-            self.author = None
+            return None
 
-        self.date = self.data['date']
-        self.message = self.data['message']
-        self.revision_number = self.data.get('_revision_number', 0)
+    @property
+    def date(self):
+        return self.data['date']
+
+    @property
+    def message(self):
+        return self.data['message']
+
+    @property
+    def revision_number(self):
+        return self.data.get('_revision_number', 0)
 
     def __str__(self):
         return self.message
 
 class Revision:
+    __slots__ = ('change_id', 'id', 'data')
+
+    # The RevisionInfo fields.
+    _number = _field('_number')
+    draft = _field('draft')
+    ref = _field('ref')
+    fetch = _field('fetch')
+    commit = _field('commit')
+    files = _field('files')
+
     def __init__(self, change_id, rev_id, data):
         self.change_id = change_id
         self.id = rev_id
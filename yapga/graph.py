@@ -0,0 +1,312 @@
+import array
+import itertools
+import logging
+import math
+
+import numpy as np
+
+import yapga.db
+
+
+log = logging.getLogger('yapga')
+
+# The parts of each change and reviewer needed to build a graph.
+CHANGE_FIELDS = ['change_id', 'owner._account_id', 'owner.name']
+REVIEWER_FIELDS = ['_account_id', 'name']
+
+
+def account_key(account):
+    """The key of the node for `account`: its account id, or
+    `('name', name)` if it has no id (as in older exports.)
+    """
+    try:
+        return account['_account_id']
+    except KeyError:
+        return ('name', account.get('name', 'UNKNOWN'))
+
+
+class _Accounts:
+    """Assigns consecutive node numbers to accounts (by `account_key`)
+    in the order they're first seen, remembering an id and a name for
+    each. Also assigns codes to the names on each document.
+    """
+    def __init__(self):
+        self.nodes = {}
+        self.keys = []
+        self.ids = array.array('q')
+        self.names = []
+        self.name_codes = {}
+
+    def name_code(self, account):
+        name = account.get('name', 'UNKNOWN')
+        try:
+            return self.name_codes[name]
+        except KeyError:
+            code = self.name_codes[name] = len(self.name_codes)
+            return code
+
+    def node(self, account):
+        key = account_key(account)
+        name = account.get('name', 'UNKNOWN')
+        try:
+            node = self.nodes[key]
+        except KeyError:
+            node = self.nodes[key] = len(self.keys)
+            self.keys.append(key)
+            self.ids.append(account.get('_account_id', -1))
+            self.names.append(name)
+            return node
+
+        # Prefer a real name to the default.
+        if self.names[node] == 'UNKNOWN':
+            self.names[node] = name
+        return node
+
+
+class _CSR:
+    """A square matrix of counts in compressed sparse row form. The
+    columns of row `i` are `indices[indptr[i]:indptr[i + 1]]` (sorted)
+    and their counts the same slice of `data`.
+    """
+    def __init__(self, size, rows, cols, weights=None):
+        self.size = size
+        keys, inverse = np.unique(
+            rows.astype(np.int64) * size + cols, return_inverse=True)
+        self.keys = keys
+        self.indices = keys % size
+        self.data = np.bincount(inverse.ravel(), weights=weights,
+                                minlength=len(keys)).astype(np.int64)
+        self.indptr = np.searchsorted(
+            keys // size, np.arange(size + 1, dtype=np.int64))
+
+    def row(self, i):
+        start, end = self.indptr[i], self.indptr[i + 1]
+        return self.indices[start:end], self.data[start:end]
+
+    def rows(self):
+        """The row of each stored count."""
+        return np.repeat(np.arange(self.size), np.diff(self.indptr))
+
+    def transpose(self):
+        return _CSR(self.size, self.indices, self.rows(), self.data)
+
+    def get(self, i, j):
+        indices, data = self.row(i)
+        k = np.searchsorted(indices, j)
+        if k < len(indices) and indices[k] == j:
+            return int(data[k])
+        return 0
+
+
+class ReviewGraph:
+    """A sparse graph of who reviews whose changes, with one node per
+    account and edges from reviewers to change owners weighted by the
+    number of reviews.
+
+    Nodes are numbered, and queries take the `account_key` of an
+    account: its account id, or `('name', name)` for accounts without
+    one. `keys`, `ids` and `names` hold the key, account id (or -1)
+    and a name for each node.
+
+    The counts by name are of the name on each document, as the
+    database aggregations count them, rather than of the node names.
+    `name_list` holds the names, `owner_names` the code of the owner
+    name of each change, `reviewer_names` that of each reviewer entry,
+    and `pair_names` the `(reviewer, owner)` codes of each review of a
+    change in the database.
+    """
+    def __init__(self, keys, ids, names, reviews,
+                 name_list, owner_names, reviewer_names, pair_names):
+        self.keys = keys
+        self.ids = ids
+        self.names = names
+        self.reviews = reviews
+        self.reviewed_by = reviews.transpose()
+        self.nodes = {key: node for node, key in enumerate(keys)}
+        self.name_list = name_list
+        self.owner_names = owner_names
+        self.reviewer_names = reviewer_names
+        self.pair_names = pair_names
+        self._reciprocity = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _top(self, matrix, key, k):
+        indices, data = matrix.row(self.nodes[key])
+        # Ties go to the lowest account id, then the first seen.
+        order = np.lexsort((indices, self.ids[indices], -data))[:k]
+        return [(self.keys[i], int(c))
+                for i, c in zip(indices[order].tolist(),
+                                data[order].tolist())]
+
+    def top_reviewers(self, owner, k=10):
+        """The `k` accounts which reviewed the most changes owned by
+        `owner`, as `(account key, count)` pairs, most first.
+        """
+        return self._top(self.reviewed_by, owner, k)
+
+    def top_owners(self, reviewer, k=10):
+        """The `k` accounts whose changes `reviewer` reviewed the most,
+        as `(account key, count)` pairs, most first.
+        """
+        return self._top(self.reviews, reviewer, k)
+
+    def review_count(self, reviewer, owner):
+        """How many changes owned by `owner` `reviewer` reviewed."""
+        return self.reviews.get(self.nodes[reviewer], self.nodes[owner])
+
+    def reciprocity_scores(self):
+        """The reciprocity of every node: the fraction of its reviews
+        of other people's changes which were matched by them reviewing
+        its own changes. For each owner only up to as many reviews as
+        they made in return count.
+        """
+        if self._reciprocity is None:
+            reviews = self.reviews
+            rows = reviews.rows()
+            others = np.where(rows != reviews.indices, reviews.data, 0)
+
+            # The reviews made in return, found by looking up the key
+            # of each transposed entry.
+            reverse = reviews.indices * reviews.size + rows
+            pos = np.searchsorted(reviews.keys, reverse)
+            found = pos < len(reviews.keys)
+            found[found] = reviews.keys[pos[found]] == reverse[found]
+            returned = np.zeros(len(rows), dtype=np.int64)
+            returned[found] = reviews.data[pos[found]]
+
+            matched = np.bincount(rows, weights=np.minimum(others, returned),
+                                  minlength=len(self))
+            made = np.bincount(rows, weights=others, minlength=len(self))
+            self._reciprocity = np.divide(
+                matched, made, out=np.zeros(len(self)), where=made > 0)
+        return self._reciprocity
+
+    def reciprocity(self, key):
+        return float(self.reciprocity_scores()[self.nodes[key]])
+
+    def _counts_by_name(self, codes):
+        if not len(codes):
+            return []
+
+        counts = np.bincount(codes)
+        uniq, first = np.unique(codes, return_index=True)
+        return [(self.name_list[c], int(counts[c]))
+                for c in uniq[np.argsort(first, kind='stable')].tolist()]
+
+    def owner_counts(self):
+        """`(name, count)` pairs of the number of changes owned by each
+        name, in the order the names are first seen.
+        """
+        return self._counts_by_name(self.owner_names)
+
+    def reviewer_counts(self):
+        """`(name, count)` pairs of the number of reviews by each name,
+        in the order the names are first seen.
+        """
+        return self._counts_by_name(self.reviewer_names)
+
+    def pair_counts(self):
+        """`((reviewer, owner), count)` pairs, by name, of how often
+        each reviewer reviewed changes of each owner.
+        """
+        size = len(self.name_list)
+        reviewers, owners = self.pair_names
+        keys, counts = np.unique(reviewers * size + owners,
+                                 return_counts=True)
+        return [((self.name_list[k // size], self.name_list[k % size]),
+                 int(c))
+                for k, c in zip(keys.tolist(), counts.tolist())]
+
+
+def build(db, batch_size=1000):
+    """Scan the change owners and reviewers in `db` once and build a
+    `ReviewGraph` from them.
+    """
+    accounts = _Accounts()
+    owners = {}
+    owner_names = array.array('q')
+
+    for change in yapga.db.all_changes(db, CHANGE_FIELDS, batch_size):
+        owner = change.data.get('owner', {})
+        owner_name = accounts.name_code(owner)
+        owners[change.data['change_id']] = (accounts.node(owner), owner_name)
+        owner_names.append(owner_name)
+
+    reviewer_names = array.array('q')
+    rows = array.array('q')
+    cols = array.array('q')
+    pair_reviewers = array.array('q')
+    pair_owners = array.array('q')
+
+    for change_id, reviewers in yapga.db.all_reviewers(
+            db, REVIEWER_FIELDS, batch_size):
+        owner, owner_name = owners.get(change_id, (-1, -1))
+        for reviewer in reviewers:
+            node = accounts.node(reviewer.data)
+            name = accounts.name_code(reviewer.data)
+            reviewer_names.append(name)
+            if owner >= 0:
+                rows.append(node)
+                cols.append(owner)
+                pair_reviewers.append(name)
+                pair_owners.append(owner_name)
+
+    size = len(accounts.keys)
+    log.info('Built review graph of {} accounts and {} reviews'.format(
+        size, len(reviewer_names)))
+
+    def column(values):
+        return np.asarray(values, dtype=np.int64)
+
+    return ReviewGraph(
+        accounts.keys,
+        column(accounts.ids),
+        accounts.names,
+        _CSR(size, column(rows), column(cols)),
+        list(accounts.name_codes),
+        column(owner_names),
+        column(reviewer_names),
+        (column(pair_reviewers), column(pair_owners)))
+
+
+def most_common(counts, fraction):
+    """Get the names of the `fraction` of `(name, count)` pairs with
+    the largest counts, sorted by name. Ties are broken by the order
+    of `counts` (the order the names are first seen, for the counts
+    from the database, snapshots and graphs.)
+    """
+    counts = sorted(counts, key=lambda x: x[1], reverse=True)
+    return list(sorted(
+        x[0] for x in
+        itertools.islice(counts, math.ceil(fraction * len(counts)))))
+
+
+def pair_matrix(pair_counts, reviewers, owners):
+    """Build a matrix of reviewer to owner from `((reviewer, owner),
+    count)` pairs, where `reviewers` and `owners` are the sorted names
+    of the rows and columns. Pairs with other names are ignored.
+    """
+    data = np.zeros((len(reviewers), len(owners)))
+    if not pair_counts or not len(data):
+        return data
+
+    pairs, counts = zip(*pair_counts)
+    pair_reviewers, pair_owners = zip(*pairs)
+
+    def indices(names, values):
+        names, values = np.asarray(names), np.asarray(values)
+        idx = np.searchsorted(names, values)
+        found = idx < len(names)
+        found[found] = names[idx[found]] == values[found]
+        return idx, found
+
+    reviewer_idx, reviewer_found = indices(reviewers, pair_reviewers)
+    owner_idx, owner_found = indices(owners, pair_owners)
+    found = reviewer_found & owner_found
+
+    np.add.at(data,
+              (reviewer_idx[found], owner_idx[found]),
+              np.asarray(counts, dtype=data.dtype)[found])
+    return data
@@ -0,0 +1,314 @@
+import array
+import datetime
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import yapga.db
+import yapga.util
+
+
+log = logging.getLogger('yapga')
+
+DEFAULT_CACHE_DIR = yapga.util.DEFAULT_CACHE_DIR
+
+# Bump this when the columns or their meaning change.
+CACHE_VERSION = 2
+
+# The parts of each change and reviewer needed to build a snapshot.
+CHANGE_FIELDS = [
+    'id',
+    'change_id',
+    '_number',
+    'owner._account_id',
+    'owner.name',
+    'created',
+    'updated',
+    'revisions',
+    'messages.author.name',
+]
+
+REVIEWER_FIELDS = ['name']
+
+
+class _StringTable:
+    """Assigns consecutive integer codes to strings in the order
+    they're first seen.
+    """
+    def __init__(self):
+        self.codes = {}
+        self.strings = []
+
+    def code(self, s):
+        try:
+            return self.codes[s]
+        except KeyError:
+            code = self.codes[s] = len(self.strings)
+            self.strings.append(s)
+            return code
+
+
+def _epoch(timestamp):
+    """Convert a gerrit timestamp (UTC "YYYY-MM-DD hh:mm:ss.nnnnnnnnn")
+    to seconds since the epoch, or NaN if it's missing.
+    """
+    if not timestamp:
+        return float('nan')
+    return datetime.datetime.fromisoformat(timestamp[:19]).replace(
+        tzinfo=datetime.timezone.utc).timestamp()
+
+
+class Snapshot:
+    """A compact, column-oriented summary of the changes and reviews
+    in a database, for analyses which only need a few scalars from
+    each change. Names (of owners, message authors and reviewers) are
+    stored as integer codes into the shared `names` list.
+
+    Per-change columns (one row per change):
+        number, owner_id, owner, created, updated, revision_count,
+        first_revision_size, message_count, review
+
+    `owner` is a code into `names`, `created`/`updated` are epoch
+    seconds and `review` is the row in the review columns for the
+    change (or -1 if it has none.)
+
+    The authors of the messages of change `i` are
+    `message_author[message_offsets[i]:message_offsets[i + 1]]`, with
+    -1 for messages without an author.
+
+    Per-review columns (one row per entry in the `reviews` collection):
+        review_change, reviewer_offsets
+
+    `review_change` is the change row for the review (or -1 if the
+    change isn't in the database), and the reviewers for review `j`
+    are `reviewer[reviewer_offsets[j]:reviewer_offsets[j + 1]]`.
+    """
+    COLUMNS = (
+        'number',
+        'owner_id',
+        'owner',
+        'created',
+        'updated',
+        'revision_count',
+        'first_revision_size',
+        'message_count',
+        'review',
+        'message_offsets',
+        'message_author',
+        'review_change',
+        'reviewer_offsets',
+        'reviewer',
+    )
+
+    def __init__(self, names, **columns):
+        self.names = names
+        for name in self.COLUMNS:
+            setattr(self, name, columns[name])
+
+    def __len__(self):
+        return len(self.number)
+
+    def owner_names(self):
+        """The owner name of each change."""
+        return [self.names[o] for o in self.owner]
+
+    def reviewers(self, row):
+        """The reviewer codes for the change in `row`."""
+        review = self.review[row]
+        if review < 0:
+            return self.reviewer[:0]
+        return self.reviewer[self.reviewer_offsets[review]:
+                             self.reviewer_offsets[review + 1]]
+
+    def counts(self, codes):
+        """Count the occurrences of each name in `codes`, returning
+        `(name, count)` pairs in the order the names first appear.
+        """
+        codes = codes[codes >= 0]
+        if not len(codes):
+            return []
+
+        counts = np.bincount(codes)
+        uniq, first = np.unique(codes, return_index=True)
+        return [(self.names[c], int(counts[c]))
+                for c in uniq[np.argsort(first, kind='stable')]]
+
+    def reviewer_owner_counts(self):
+        """Count how often each reviewer reviewed changes of each
+        owner, returning `((reviewer, owner), count)` pairs.
+        """
+        # The change row of each reviewer, keeping only the review
+        # each change row refers to.
+        review_change = np.asarray(self.review_change)
+        current = review_change >= 0
+        current[current] = (
+            self.review[review_change[current]] ==
+            np.flatnonzero(current))
+        rows = np.repeat(np.where(current, review_change, -1),
+                         np.diff(self.reviewer_offsets))
+        reviewers = np.asarray(self.reviewer)[rows >= 0]
+        owners = np.asarray(self.owner)[rows[rows >= 0]]
+
+        size = len(self.names)
+        pairs, counts = np.unique(
+            reviewers.astype(np.int64) * size + owners,
+            return_counts=True)
+        return [((self.names[p // size], self.names[p % size]), int(c))
+                for p, c in zip(pairs.tolist(), counts.tolist())]
+
+
+def build(db, batch_size=1000):
+    """Scan the changes and reviews in `db` once and build a
+    `Snapshot` from them.
+    """
+    names = _StringTable()
+    rows = {}
+
+    number = array.array('q')
+    owner_id = array.array('q')
+    owner = array.array('i')
+    created = array.array('d')
+    updated = array.array('d')
+    revision_count = array.array('i')
+    first_revision_size = array.array('q')
+    message_offsets = array.array('q', [0])
+    message_author = array.array('i')
+
+    for change in yapga.db.all_changes(db, CHANGE_FIELDS, batch_size):
+        rows[change.data['change_id']] = len(number)
+
+        number.append(change.data.get('_number', -1))
+        owner_data = change.data.get('owner', {})
+        owner_id.append(owner_data.get('_account_id', -1))
+        owner.append(names.code(change.owner.name))
+        created.append(_epoch(change.data.get('created')))
+        updated.append(_epoch(change.data.get('updated')))
+
+        revision_count.append(change.revision_count)
+        first = change.first_revision
+        first_revision_size.append(first.size() if first is not None else 0)
+
+        for msg in change.data.get('messages', []):
+            author = msg.get('author')
+            message_author.append(
+                -1 if author is None else
+                names.code(author.get('name', 'UNKNOWN')))
+        message_offsets.append(len(message_author))
+
+    review = np.full(len(number), -1, dtype=np.int64)
+    review_change = array.array('q')
+    reviewer_offsets = array.array('q', [0])
+    reviewer = array.array('i')
+
+    for change_id, reviewers in yapga.db.all_reviewers(
+            db, REVIEWER_FIELDS, batch_size):
+        row = rows.get(change_id, -1)
+        if row >= 0:
+            review[row] = len(review_change)
+        review_change.append(row)
+        reviewer.extend(names.code(r.name) for r in reviewers)
+        reviewer_offsets.append(len(reviewer))
+
+    message_offsets = np.asarray(message_offsets, dtype=np.int64)
+
+    return Snapshot(
+        names.strings,
+        number=np.asarray(number, dtype=np.int64),
+        owner_id=np.asarray(owner_id, dtype=np.int64),
+        owner=np.asarray(owner, dtype=np.int32),
+        created=np.asarray(created, dtype=np.float64),
+        updated=np.asarray(updated, dtype=np.float64),
+        revision_count=np.asarray(revision_count, dtype=np.int32),
+        first_revision_size=np.asarray(first_revision_size, dtype=np.int64),
+        message_count=np.diff(message_offsets).astype(np.int32),
+        review=review,
+        message_offsets=message_offsets,
+        message_author=np.asarray(message_author, dtype=np.int32),
+        review_change=np.asarray(review_change, dtype=np.int64),
+        reviewer_offsets=np.asarray(reviewer_offsets, dtype=np.int64),
+        reviewer=np.asarray(reviewer, dtype=np.int32))
+
+
+def save(snapshot, path, state):
+    """Save `snapshot` under the directory `path` as one `.npy` file
+    per column, tagged with the database `state` it was built from.
+
+    Each save writes its columns into a new subdirectory, so the files
+    of a snapshot which is memory-mapped are never overwritten.
+    """
+    os.makedirs(path, exist_ok=True)
+    columns = tempfile.mkdtemp(prefix='columns-', dir=path)
+
+    for name in Snapshot.COLUMNS:
+        np.save(os.path.join(columns, name + '.npy'),
+                np.asarray(getattr(snapshot, name)))
+
+    # The metadata is switched over last, so a half-written cache never
+    # looks valid.
+    meta_file = os.path.join(path, 'meta.json')
+    with open(meta_file + '.tmp', 'wt') as f:
+        json.dump({'state': state,
+                   'names': snapshot.names,
+                   'columns': os.path.basename(columns)}, f)
+    os.replace(meta_file + '.tmp', meta_file)
+
+    # Snapshots loaded from earlier saves keep their files until
+    # they're unmapped.
+    for entry in os.listdir(path):
+        if entry.startswith('columns-') and \
+                entry != os.path.basename(columns):
+            shutil.rmtree(os.path.join(path, entry), ignore_errors=True)
+
+
+def load_cached(path, state=None):
+    """Load a snapshot saved in `path`, memory-mapping its columns.
+
+    Returns None if there's no cached snapshot or if `state` is given
+    and doesn't match the state it was saved with.
+    """
+    try:
+        with open(os.path.join(path, 'meta.json'), 'rt') as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    if state is not None and meta['state'] != state:
+        return None
+
+    columns_dir = os.path.join(path, meta.get('columns', ''))
+    try:
+        columns = {name: np.load(os.path.join(columns_dir, name + '.npy'),
+                                 mmap_mode='r')
+                   for name in Snapshot.COLUMNS}
+    except FileNotFoundError:
+        # Removed by another save.
+        return None
+    return Snapshot(meta['names'], **columns)
+
+
+def load(db, cache_dir=DEFAULT_CACHE_DIR):
+    """Get a `Snapshot` of `db`, using the one cached under
+    `cache_dir` if the database hasn't changed since it was built.
+
+    A fresh snapshot is built (and cached) otherwise. If `cache_dir`
+    is empty, no cache is used.
+    """
+    if not cache_dir:
+        return build(db)
+
+    path = os.path.join(cache_dir, yapga.db.db_key(db))
+    state = dict(yapga.db.content_state(db), version=CACHE_VERSION)
+
+    snapshot = load_cached(path, state)
+    if snapshot is not None:
+        log.info('Using cached snapshot in {}'.format(path))
+        return snapshot
+
+    log.info('Building snapshot of {}'.format(db.name))
+    snapshot = build(db)
+    save(snapshot, path, state)
+    return snapshot
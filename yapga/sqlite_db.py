@@ -0,0 +1,334 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import yapga.db
+from yapga.gerrit_api import Change, Reviewer
+
+
+log = logging.getLogger('yapga')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS changes (
+    change_id TEXT PRIMARY KEY,
+    updated TEXT,
+    owner_id INTEGER,
+    project TEXT,
+    status TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS changes_updated ON changes (updated);
+CREATE INDEX IF NOT EXISTS changes_owner_id ON changes (owner_id);
+CREATE INDEX IF NOT EXISTS changes_project ON changes (project);
+CREATE INDEX IF NOT EXISTS changes_status ON changes (status);
+
+CREATE TABLE IF NOT EXISTS reviews (
+    change_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS state (
+    collection TEXT NOT NULL,
+    key TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (collection, key)
+);
+'''
+
+# The SQL equivalents of `yapga.db.PIPELINES`.
+QUERIES = {
+    'changes_missing_reviewers': '''
+        SELECT c.change_id FROM changes c
+        LEFT JOIN reviews r ON r.change_id = c.change_id
+        WHERE r.change_id IS NULL''',
+
+    'owner_change_counts': '''
+        SELECT coalesce(json_extract(data, '$.owner.name'), 'UNKNOWN'),
+               count(*)
+        FROM changes GROUP BY 1 ORDER BY min(rowid)''',
+
+    'message_author_counts': '''
+        SELECT name, count(*) FROM (
+            SELECT coalesce(json_extract(m.value, '$.author.name'),
+                            'UNKNOWN') AS name,
+                   row_number() OVER (ORDER BY changes.rowid, m.key) AS seq
+            FROM changes, json_each(changes.data, '$.messages') m
+            WHERE json_type(m.value, '$.author') IS NOT NULL)
+        GROUP BY name ORDER BY min(seq)''',
+
+    'reviewer_counts': '''
+        SELECT name, count(*) FROM (
+            SELECT coalesce(json_extract(r.value, '$.name'),
+                            'UNKNOWN') AS name,
+                   row_number() OVER (ORDER BY reviews.rowid, r.key) AS seq
+            FROM reviews, json_each(reviews.data) r)
+        GROUP BY name ORDER BY min(seq)''',
+
+    'reviewer_owner_counts': '''
+        SELECT coalesce(json_extract(r.value, '$.name'), 'UNKNOWN'),
+               coalesce(json_extract(c.data, '$.owner.name'), 'UNKNOWN'),
+               count(*)
+        FROM reviews
+        JOIN changes c ON c.change_id = reviews.change_id,
+             json_each(reviews.data) r
+        GROUP BY 1, 2''',
+}
+
+
+def path(dbname):
+    """Get the file path from a 'sqlite:PATH' (or 'sqlite:///PATH')
+    database name.
+    """
+    dbname = dbname[len('sqlite:'):]
+    if dbname.startswith('//'):
+        dbname = dbname[2:]
+    return dbname
+
+
+class SQLiteDatabase:
+    """A yapga database stored in a single SQLite file.
+
+    It can be used with all of the `yapga.db` storage functions in
+    place of a MongoDB database. Documents are stored as JSON, with
+    the fields we look up by (change-id, updated, owner, project and
+    status) in indexed columns. Aggregations use the JSON1 extension.
+
+    One instance can be shared between threads.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def execute(self, sql, params=()):
+        """Run `sql` and return all of the resulting rows."""
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def iterate(self, sql, params=(), batch_size=None):
+        """Run `sql`, generating the resulting rows as they're
+        fetched `batch_size` at a time.
+        """
+        with self.lock:
+            cursor = self.conn.execute(sql, params)
+
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(batch_size or 1000)
+            if not rows:
+                return
+            yield from rows
+
+    def write(self, sql, rows, kind):
+        """Run `sql` for each of `rows` in a single transaction,
+        returning the number of rows written.
+        """
+        rows = list(rows)
+        if not rows:
+            return 0
+
+        start = time.perf_counter()
+        with self.lock, self.conn:
+            self.conn.executemany(sql, rows)
+        elapsed = time.perf_counter() - start
+        log.info('Wrote {} {} in {:.2f}s ({:.0f}/s)'.format(
+            len(rows), kind, elapsed, len(rows) / elapsed if elapsed else 0))
+        return len(rows)
+
+    def __repr__(self):
+        return 'SQLiteDatabase({!r})'.format(self.path)
+
+
+def _get_state(db, collection, key):
+    rows = db.execute(
+        'SELECT data FROM state WHERE collection = ? AND key = ?',
+        (collection, key))
+    return json.loads(rows[0][0]) if rows else None
+
+
+def _set_state(db, collection, key, data):
+    with db.lock, db.conn:
+        db.conn.execute(
+            'INSERT OR REPLACE INTO state VALUES (?, ?, ?)',
+            (collection, key, json.dumps(data)))
+
+
+def _query_plan(db, sql, params=()):
+    return '; '.join(row[-1] for row in db.execute(
+        'EXPLAIN QUERY PLAN ' + sql, params))
+
+
+@yapga.db.insert_changes.register(SQLiteDatabase)
+def _(db, changes, write_concern=None):
+    return db.write(
+        'INSERT OR REPLACE INTO changes VALUES (?, ?, ?, ?, ?, ?)',
+        ((c['change_id'],
+          c.get('updated'),
+          c.get('owner', {}).get('_account_id'),
+          c.get('project'),
+          c.get('status'),
+          json.dumps(c))
+         for c in changes),
+        'changes')
+
+
+@yapga.db.insert_change.register(SQLiteDatabase)
+def _(db, change):
+    yapga.db.insert_changes(db, [change])
+
+
+@yapga.db.insert_reviews.register(SQLiteDatabase)
+def _(db, reviews, write_concern=None):
+    return db.write(
+        'INSERT OR REPLACE INTO reviews VALUES (?, ?)',
+        ((change_id, json.dumps(list(reviewers)))
+         for change_id, reviewers in reviews),
+        'reviews')
+
+
+@yapga.db.insert_reviewers.register(SQLiteDatabase)
+def _(db, change_id, reviewers, upsert=True):
+    yapga.db.insert_reviews(db, [(change_id, reviewers)])
+
+
+@yapga.db.all_changes.register(SQLiteDatabase)
+def _(db, fields=None, batch_size=None):
+    # Whole documents are always returned; `fields` is only an
+    # optimization for MongoDB.
+    for (data,) in db.iterate('SELECT data FROM changes ORDER BY rowid',
+                              batch_size=batch_size):
+        yield Change(json.loads(data))
+
+
+@yapga.db.all_reviewers.register(SQLiteDatabase)
+def _(db, fields=None, batch_size=None):
+    for change_id, data in db.iterate(
+            'SELECT change_id, data FROM reviews ORDER BY rowid',
+            batch_size=batch_size):
+        yield (change_id, [Reviewer(r) for r in json.loads(data)])
+
+
+@yapga.db.get_reviewers.register(SQLiteDatabase)
+def _(db, change_id):
+    for change_id, data in db.execute(
+            'SELECT change_id, data FROM reviews WHERE change_id = ?',
+            (change_id,)):
+        yield {'change_id': change_id, 'reviewers': json.loads(data)}
+
+
+@yapga.db.changes_missing_reviewers.register(SQLiteDatabase)
+def _(db):
+    for (change_id,) in db.iterate(QUERIES['changes_missing_reviewers']):
+        yield change_id
+
+
+@yapga.db.owner_change_counts.register(SQLiteDatabase)
+def _(db):
+    return db.iterate(QUERIES['owner_change_counts'])
+
+
+@yapga.db.message_author_counts.register(SQLiteDatabase)
+def _(db):
+    return db.iterate(QUERIES['message_author_counts'])
+
+
+@yapga.db.reviewer_counts.register(SQLiteDatabase)
+def _(db):
+    return db.iterate(QUERIES['reviewer_counts'])
+
+
+@yapga.db.reviewer_owner_counts.register(SQLiteDatabase)
+def _(db):
+    for reviewer, owner, count in db.iterate(
+            QUERIES['reviewer_owner_counts']):
+        yield ((reviewer, owner), count)
+
+
+def _sync_key(server, status):
+    return '{}:{}'.format(server, status)
+
+
+@yapga.db.get_high_water_mark.register(SQLiteDatabase)
+def _(db, server, status):
+    state = _get_state(db, 'sync_state', _sync_key(server, status))
+    if state is not None:
+        return state['updated']
+
+    statuses = yapga.db.QUERY_STATUSES.get(status)
+    if statuses is None:
+        return None
+    return db.execute(
+        'SELECT max(updated) FROM changes WHERE status IN ({})'.format(
+            ', '.join('?' * len(statuses))),
+        statuses)[0][0]
+
+
+@yapga.db.set_high_water_mark.register(SQLiteDatabase)
+def _(db, server, status, updated):
+    key = _sync_key(server, status)
+    with db.lock:
+        state = _get_state(db, 'sync_state', key)
+        if state is None or state['updated'] < updated:
+            _set_state(db, 'sync_state', key, {'updated': updated})
+
+
+@yapga.db.get_crawl_state.register(SQLiteDatabase)
+def _(db, crawl):
+    state = _get_state(db, 'crawl_state', crawl)
+    if state is not None:
+        state['_id'] = crawl
+    return state
+
+
+@yapga.db.save_crawl_state.register(SQLiteDatabase)
+def _(db, crawl, **state):
+    state['saved_at'] = datetime.datetime.utcnow().isoformat()
+    _set_state(db, 'crawl_state', crawl, state)
+
+
+@yapga.db.content_state.register(SQLiteDatabase)
+def _(db):
+    changes, updated = db.execute(
+        'SELECT count(*), max(updated) FROM changes')[0]
+    reviews = db.execute('SELECT count(*) FROM reviews')[0][0]
+    return {'changes': changes, 'reviews': reviews, 'updated': updated}
+
+
+@yapga.db.db_key.register(SQLiteDatabase)
+def _(db):
+    digest = hashlib.sha1(
+        os.path.abspath(db.path).encode('utf-8')).hexdigest()
+    return 'sqlite_{}_{}'.format(db.name, digest[:8])
+
+
+@yapga.db.explain_find.register(SQLiteDatabase)
+def _(db, coll, query=None, fields=None, sort=None):
+    sql = 'SELECT data FROM {}'.format(coll)
+    params = []
+    if query:
+        sql += ' WHERE ' + ' AND '.join('{} = ?'.format(k) for k in query)
+        params = list(query.values())
+    if sort:
+        sql += ' ORDER BY ' + ', '.join(
+            '{} {}'.format(k, 'DESC' if d < 0 else 'ASC') for k, d in sort)
+    return _query_plan(db, sql, params)
+
+
+@yapga.db.explain_aggregate.register(SQLiteDatabase)
+def _(db, name):
+    return _query_plan(db, QUERIES[name])
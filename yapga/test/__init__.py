@@ -1 +1,35 @@
+import contextlib
+import os
+import shutil
+import tempfile
+
+import yapga.db
+
+
+@contextlib.contextmanager
+def temp_dir():
+    """Make a temporary directory, removing it and everything in it on
+    exit.
+    """
+    path = tempfile.mkdtemp()
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path)
+
+
+@contextlib.contextmanager
+def temp_sqlite_db(changes=(), reviews=()):
+    """Open a new SQLite database in a temporary directory holding
+    `changes` and `reviews`. It's closed and removed on exit.
+
+    The database can be opened again as `'sqlite:' + db.path`.
+    """
+    with temp_dir() as path:
+        with yapga.db.get_db('sqlite:' + os.path.join(path, 'test.db')) as db:
+            if changes:
+                yapga.db.insert_changes(db, changes)
+            if reviews:
+                yapga.db.insert_reviews(db, reviews)
+            yield db
 
@@ -0,0 +1,46 @@
+import unittest
+
+import yapga.analysis
+from yapga.test import temp_sqlite_db
+
+
+class MergeFieldsTests(unittest.TestCase):
+    def test_merge(self):
+        self.assertEqual(
+            yapga.analysis.merge_fields([['owner.name', 'revisions'],
+                                         ['revisions.x', 'owner.name']]),
+            ['owner.name', 'revisions'])
+
+    def test_whole_change(self):
+        self.assertIsNone(
+            yapga.analysis.merge_fields([['owner.name'], None]))
+
+
+class RunTests(unittest.TestCase):
+    def test_single_pass(self):
+        changes = [
+            {'change_id': 'I1', 'id': 'p~b~I1',
+             'owner': {'name': 'alice'},
+             'revisions': {'a': {}, 'b': {}},
+             'messages': [{'author': {'name': 'bob'}}, {}]},
+            {'change_id': 'I2', 'id': 'p~b~I2',
+             'owner': {'name': 'alice'}},
+        ]
+        with temp_sqlite_db(changes) as db:
+            metrics = yapga.analysis.create(
+                ['revision_counts', 'changes_by_owner', 'messages_by_user'])
+            self.assertEqual(yapga.analysis.run(db, metrics), 2)
+
+        revision_counts, changes_by_owner, messages_by_user = metrics
+        self.assertEqual(revision_counts.counts, {2: 1, 0: 1})
+        self.assertEqual(changes_by_owner.counts, {'alice': 2})
+        self.assertEqual(messages_by_user.messages, {'bob': 1})
+
+
+class MetricTests(unittest.TestCase):
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            yapga.analysis.Metric()
+
+    def test_word_count_registered(self):
+        self.assertIn('word_count', yapga.analysis.METRICS)
@@ -0,0 +1,221 @@
+import collections
+import collections.abc
+import copy
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import yapga.anonymize as anonymize
+
+
+def data_file_path(filename):
+    own_dir = os.path.split(os.path.join(os.getcwd(), __file__))[0]
+    data_dir = os.path.join(own_dir, 'data')
+    return os.path.join(data_dir, filename)
+
+
+def load_changes():
+    with open(data_file_path('basic_changes.json'), 'rt') as f:
+        return json.load(f)
+
+
+def write_array(filename, changes):
+    with open(filename, 'wt') as f:
+        json.dump(changes, f)
+
+
+def write_lines(filename, changes):
+    with open(filename, 'wt') as f:
+        for change in changes:
+            f.write(json.dumps(change) + '\n')
+
+
+def read_changes(filename):
+    with open(filename, 'rb') as f:
+        return list(anonymize.read_changes(f)[1])
+
+
+def recursive_transform(obj, t):
+    # The recursive json_transform which anonymize_changes used to use.
+    if isinstance(obj, str):
+        return
+
+    if isinstance(obj, collections.abc.Mapping):
+        for k, v in obj.items():
+            obj[k] = t(k, v)
+            recursive_transform(obj[k], t)
+
+    elif isinstance(obj, collections.abc.Sequence):
+        for x in obj:
+            recursive_transform(x, t)
+
+
+def recursive_anonymize(changes):
+    # The old anonymize_changes, without the files.
+    name_map = collections.defaultdict(anonymize.Replacer('UNKNOWN_{}'))
+    mail_map = collections.defaultdict(
+        anonymize.Replacer('UNKNOWN_{}@UNKNOWN.UNK'))
+
+    def anon(key, value):
+        if not isinstance(value, str):
+            return value
+        if key == 'email':
+            return mail_map[value]
+        if key == 'name':
+            return name_map[value]
+        return value
+
+    recursive_transform(changes, anon)
+    return changes
+
+
+def nested(depth, name):
+    # A change DEPTH levels deep, with the name NAME(level) at each one.
+    change = {}
+    for level in reversed(range(depth)):
+        change = {'name': name(level), 'children': [change]}
+    return change
+
+
+def nested_names(change):
+    names = []
+    while change:
+        names.append(change['name'])
+        change = change['children'][0]
+    return names
+
+
+class AnonymizeChangesTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.expected = recursive_anonymize(load_changes())
+
+    def path(self, filename):
+        return os.path.join(self.dir, filename)
+
+    def test_array_matches_recursive(self):
+        anonymize.anonymize_file(data_file_path('basic_changes.json'),
+                                 self.path('out.json'))
+        with open(self.path('out.json'), 'rt') as f:
+            self.assertEqual(json.load(f), self.expected)
+
+    def test_json_lines_matches_recursive(self):
+        write_lines(self.path('in.jsonl'), load_changes())
+        anonymize.anonymize_file(self.path('in.jsonl'),
+                                 self.path('out.jsonl'))
+        with open(self.path('out.jsonl'), 'rt') as f:
+            self.assertEqual([json.loads(line) for line in f],
+                             self.expected)
+
+    def test_deep_nesting(self):
+        depth = sys.getrecursionlimit() * 2
+        with self.assertRaises(RecursionError):
+            recursive_anonymize(nested(depth, lambda level: 'x'))
+
+        change = anonymize.Anonymizer()(
+            nested(depth, lambda level: 'user{}'.format(level % 3)))
+        self.assertEqual(
+            nested_names(change),
+            ['UNKNOWN_{}'.format(level % 3 + 1) for level in range(depth)])
+
+
+class AnonymizeShardsTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.changes = load_changes()
+
+    def path(self, *parts):
+        return os.path.join(self.dir, *parts)
+
+    def write_shards(self, dirname, shards):
+        os.makedirs(self.path(dirname))
+        for filename, changes in shards:
+            if filename.endswith('.jsonl'):
+                write_lines(self.path(dirname, filename), changes)
+            else:
+                write_array(self.path(dirname, filename), changes)
+
+    def read_shards(self, dirname):
+        return {f: read_changes(self.path(dirname, f))
+                for f in os.listdir(self.path(dirname))}
+
+    def test_numbered_matches_single_file(self):
+        first, second = self.changes
+        shards = [('a.json', [first]),
+                  ('b.jsonl', [second]),
+                  ('c.json', [second, first])]
+        self.write_shards('in', shards)
+        anonymize.anonymize_shards(self.path('in'), self.path('out'),
+                                   jobs=2)
+
+        write_lines(self.path('all.jsonl'), [first, second, second, first])
+        anonymize.anonymize_file(self.path('all.jsonl'),
+                                 self.path('all.out.jsonl'))
+
+        results = self.read_shards('out')
+        self.assertEqual(
+            results['a.json'] + results['b.jsonl'] + results['c.json'],
+            read_changes(self.path('all.out.jsonl')))
+
+    def test_shards_keep_format(self):
+        self.write_shards('in', [('a.json', self.changes),
+                                 ('b.jsonl', self.changes)])
+        anonymize.anonymize_shards(self.path('in'), self.path('out'),
+                                   jobs=1)
+
+        with open(self.path('out', 'a.json'), 'rt') as f:
+            self.assertEqual(f.read(1), '[')
+        with open(self.path('out', 'b.jsonl'), 'rt') as f:
+            self.assertEqual(len(f.readlines()), 2)
+
+    def test_keyed_independent_of_jobs_and_order(self):
+        first, second = self.changes
+        self.write_shards('in1', [('a.json', [first]), ('b.json', [second])])
+        self.write_shards('in2', [('a.json', [second]), ('b.json', [first])])
+        anonymize.anonymize_shards(self.path('in1'), self.path('out1'),
+                                   jobs=1, key='secret')
+        anonymize.anonymize_shards(self.path('in2'), self.path('out2'),
+                                   jobs=3, key='secret')
+
+        out1 = self.read_shards('out1')
+        out2 = self.read_shards('out2')
+        self.assertEqual(out1['a.json'], out2['b.json'])
+        self.assertEqual(out1['b.json'], out2['a.json'])
+
+        other = anonymize.Anonymizer(
+            anonymize.pseudonyms(anonymize.NAME_TEMPLATE, key='other'),
+            anonymize.pseudonyms(anonymize.MAIL_TEMPLATE, key='other'))
+        self.assertNotEqual(other(copy.deepcopy(first)), out1['a.json'][0])
+
+    def test_mapping_reused(self):
+        first, second = self.changes
+        mapping = self.path('mapping.json')
+
+        self.write_shards('in1', [('a.json', [first])])
+        anonymize.anonymize_shards(self.path('in1'), self.path('out1'),
+                                   mapping=mapping)
+        names1, mails1 = anonymize.load_mapping(mapping)
+
+        self.write_shards('in2', [('a.json', [second]), ('b.json', [first])])
+        anonymize.anonymize_shards(self.path('in2'), self.path('out2'),
+                                   mapping=mapping)
+        names2, mails2 = anonymize.load_mapping(mapping)
+
+        # Earlier pseudonyms are kept...
+        self.assertEqual(self.read_shards('out2')['b.json'],
+                         self.read_shards('out1')['a.json'])
+        for old, new in ((names1, names2), (mails1, mails2)):
+            self.assertEqual({k: new[k] for k in old}, old)
+
+        # ...and new ones are numbered after them.
+        new_names = sorted(
+            int(v[len('UNKNOWN_'):]) for k, v in names2.items()
+            if k not in names1)
+        self.assertTrue(new_names)
+        self.assertEqual(new_names,
+                         list(range(len(names1) + 1, len(names2) + 1)))
@@ -55,6 +55,30 @@ class APITests(unittest.TestCase):
         self.assertEqual(len(list(self.changes[0].revisions)), 2)
         self.assertEqual(len(list(self.changes[1].revisions)), 3)
 
+    def test_revision_count_accessor(self):
+        for change in self.changes:
+            self.assertEqual(change.revision_count,
+                             len(list(change.revisions)))
+
+    def test_first_revision(self):
+        for change in self.changes:
+            self.assertEqual(change.first_revision.id,
+                             next(change.revisions).id)
+
+    def test_messages(self):
+        for change in self.changes:
+            self.assertEqual(change.message_count,
+                             len(list(change.messages)))
+            for msg, data in zip(change.messages,
+                                 change.data.get('messages', [])):
+                self.assertEqual(msg.message, data['message'])
+                self.assertEqual(msg.date, data['date'])
+                if 'author' in data:
+                    self.assertEqual(msg.author.name,
+                                     data['author'].get('name', 'UNKNOWN'))
+                else:
+                    self.assertIsNone(msg.author)
+
     def test_revisions(self):
         # TODO: commit
         # TODO: files
@@ -0,0 +1,48 @@
+import copy
+import unittest
+
+import yapga.db
+
+
+class EscapeTests(unittest.TestCase):
+    def setUp(self):
+        self.data = {
+            'change_id': 'I123',
+            'revisions': {
+                'abc': {
+                    'files': {
+                        'src/main.py': {'lines_inserted': 1},
+                        '$weird.name': {'lines_deleted': 2},
+                        'README': {},
+                    },
+                },
+            },
+            'messages': [
+                {'message': 'a.b', 'labels': {'Code.Review': 1}},
+            ],
+        }
+
+    def test_escape(self):
+        escaped = yapga.db.escape_struct(copy.deepcopy(self.data))
+        files = escaped['revisions']['abc']['files']
+        self.assertEqual(list(files),
+                         ['src/main<DOT>py',
+                          '<DOLLAR_SIGN>weird<DOT>name',
+                          'README'])
+
+    def test_escape_descends_into_lists(self):
+        escaped = yapga.db.escape_struct(copy.deepcopy(self.data))
+        self.assertEqual(escaped['messages'][0],
+                         {'message': 'a.b', 'labels': {'Code<DOT>Review': 1}})
+
+    def test_round_trip(self):
+        escaped = yapga.db.escape_struct(copy.deepcopy(self.data))
+        self.assertEqual(yapga.db.unescape_struct(escaped), self.data)
+
+    def test_untouched_mappings_are_unchanged(self):
+        data = {'a': {'b': 1}, 'c': [1, 'x.y']}
+        self.assertEqual(yapga.db.escape_struct(copy.deepcopy(data)), data)
+
+    def test_non_containers(self):
+        self.assertEqual(yapga.db.escape_struct('a.b'), 'a.b')
+        self.assertEqual(yapga.db.unescape_struct(None), None)
@@ -0,0 +1,266 @@
+import re
+import unittest
+import unittest.mock
+import urllib.parse
+
+import yapga.db
+import yapga.fetch
+import yapga.gerrit_api
+from yapga.test import temp_sqlite_db
+from yapga.test.test_transport import (PASSWORD, USERNAME,
+                                       StubGerritHandler, serve)
+
+
+STATUSES = {'merged': 'MERGED', 'open': 'NEW'}
+
+
+def make_change(n, status='MERGED', updated='2014-01-01 10:00:00.000000000'):
+    return {
+        'change_id': 'I{}'.format(n),
+        'id': 'p~master~I{}'.format(n),
+        '_number': n,
+        '_sortkey': '{:08x}'.format(n),
+        'status': status,
+        'updated': updated,
+        'owner': {'_account_id': 1, 'name': 'alice'},
+    }
+
+
+def query_page(changes, queries):
+    """The page of `changes` gerrit would return for `queries`, newest
+    first.
+    """
+    params = dict(q.split('=', 1) for q in queries)
+    query = urllib.parse.unquote_plus(params['q'])
+    status = STATUSES[re.search(r'status:(\w+)', query).group(1)]
+    after = re.search(r'after:"([^"]*)"', query)
+
+    matching = sorted(
+        (c for c in changes
+         if c['status'] == status and
+         (after is None or c['updated'][:19] > after.group(1)) and
+         ('N' not in params or c['_sortkey'] < params['N'])),
+        key=lambda c: c['_sortkey'], reverse=True)
+
+    page = [dict(c) for c in matching[:int(params.get('n', 500))]]
+    if page and len(matching) > len(page):
+        page[-1]['_more_changes'] = True
+    return page
+
+
+class FakeConnection:
+    """A `Connection` serving `changes` in pages, which fails requests
+    as told by `failures`: a map from the request number to the number
+    of changes it generates before raising `error`.
+    """
+    def __init__(self, changes, failures=None, error=OSError('reset')):
+        self.changes = changes
+        self.failures = failures or {}
+        self.error = error
+        self.requests = []
+
+    def req_stream(self, path, queries=None):
+        number = len(self.requests)
+        self.requests.append(queries)
+        page = query_page(self.changes, queries)
+        if number in self.failures:
+            yield from page[:self.failures[number]]
+            raise self.error
+        yield from page
+
+
+class FetchChangesTests(unittest.TestCase):
+    def setUp(self):
+        self.changes = [make_change(n) for n in range(1, 11)]
+        patcher = unittest.mock.patch('time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch(self, conn, retries):
+        return list(yapga.gerrit_api.fetch_changes(
+            conn, ['q=status:merged', 'n=4'], stream=True, retries=retries))
+
+    def sortkeys(self, changes):
+        return [c['_sortkey'] for c in changes]
+
+    def start_keys(self, conn):
+        return [dict(q.split('=', 1) for q in queries).get('N')
+                for queries in conn.requests]
+
+    def test_retry_after_mid_page_failure(self):
+        conn = FakeConnection(self.changes, {1: 2})
+        changes = self.fetch(conn, retries=1)
+
+        # Nothing is repeated or skipped.
+        self.assertEqual(self.sortkeys(changes),
+                         self.sortkeys(reversed(self.changes)))
+        self.assertEqual(self.start_keys(conn),
+                         [None, '00000007', '00000005'])
+
+    def test_failure_before_first_change(self):
+        conn = FakeConnection(self.changes, {0: 0})
+        self.assertEqual(len(self.fetch(conn, retries=1)), 10)
+        self.assertEqual(self.start_keys(conn)[:2], [None, None])
+
+    def test_backoff(self):
+        conn = FakeConnection(self.changes, {0: 1, 1: 1, 2: 1})
+        self.assertEqual(len(self.fetch(conn, retries=3)), 10)
+        self.assertEqual([c[0][0] for c in self.sleep.call_args_list],
+                         [1.0, 2.0, 4.0])
+
+    def test_backoff_reset_after_page(self):
+        # Failures on the first and third pages, with only one retry
+        # allowed in a row.
+        conn = FakeConnection(self.changes, {0: 1, 2: 1})
+        self.assertEqual(len(self.fetch(conn, retries=1)), 10)
+        self.assertEqual([c[0][0] for c in self.sleep.call_args_list],
+                         [1.0, 1.0])
+
+    def test_gives_up(self):
+        conn = FakeConnection(self.changes, {0: 1, 1: 1})
+        with self.assertRaises(OSError):
+            self.fetch(conn, retries=1)
+
+    def test_not_transient(self):
+        conn = FakeConnection(self.changes, {0: 1}, ValueError('bad'))
+        with self.assertRaises(ValueError):
+            self.fetch(conn, retries=3)
+        self.assertFalse(self.sleep.called)
+
+
+class StubChangesHandler(StubGerritHandler):
+    """Answers change queries from `server.changes` and reviewer
+    requests from `server.reviewers`. Pages whose numbers are in
+    `server.fail_pages` fail with a 500 error, and the queries of all
+    pages are recorded in `server.queries`.
+    """
+    def respond(self):
+        parts = urllib.parse.urlsplit(self.path)
+        path = parts.path.strip('/').split('/')
+
+        if path[1:] == ['changes']:
+            self.server.queries.append(parts.query.split('&'))
+            if len(self.server.queries) in self.server.fail_pages:
+                self._send(500, b'Internal error')
+                return
+            self._send_json(query_page(self.server.changes,
+                                       parts.query.split('&')))
+
+        elif path[1] == 'changes' and path[3:] == ['reviewers']:
+            try:
+                self._send_json(self.server.reviewers[path[2]])
+            except KeyError:
+                self._send(404, b'Not found')
+
+        else:
+            self._send(404, b'Not found')
+
+
+class FetchTests(unittest.TestCase):
+    def setUp(self):
+        self.server, self.uri = serve(self, StubChangesHandler)
+        self.server.changes = [make_change(n) for n in range(1, 11)]
+        self.server.reviewers = {}
+        self.server.fail_pages = set()
+        self.server.queries = []
+
+        self.conn = yapga.gerrit_api.create_connection(
+            self.uri, USERNAME, PASSWORD, pooled=True)
+        self.addCleanup(self.conn.opener.close)
+
+        self.db = self.enter(temp_sqlite_db())
+
+    def enter(self, context):
+        result = context.__enter__()
+        self.addCleanup(context.__exit__, None, None, None)
+        return result
+
+    def fetch(self, **kwargs):
+        return yapga.fetch.fetch(self.db, self.conn, self.uri,
+                                 batch_size=4, retries=0, **kwargs)
+
+    def change_ids(self):
+        return sorted(c.change_id for c in yapga.db.all_changes(self.db))
+
+    def crawl_state(self, status='merged'):
+        return yapga.db.get_crawl_state(
+            self.db, 'fetch:{}:{}'.format(self.uri, status))
+
+    def test_fetch(self):
+        self.assertTrue(self.fetch())
+        self.assertEqual(len(self.change_ids()), 10)
+        state = self.crawl_state()
+        self.assertTrue(state['complete'])
+        self.assertEqual(state['changes'], 10)
+        self.assertEqual(state['sortkey'], '00000001')
+
+    def test_resume(self):
+        self.server.fail_pages = {2}
+        self.assertFalse(self.fetch())
+
+        state = self.crawl_state()
+        self.assertFalse(state['complete'])
+        self.assertEqual(state['changes'], 4)
+        self.assertEqual(state['sortkey'], '00000007')
+        self.assertEqual(len(self.change_ids()), 4)
+
+        self.server.queries = []
+        self.server.fail_pages = set()
+        self.assertTrue(self.fetch(resume=True))
+
+        self.assertIn('N=00000007', self.server.queries[0])
+        self.assertEqual(len(self.server.queries), 2)
+        self.assertEqual(len(self.change_ids()), 10)
+        state = self.crawl_state()
+        self.assertTrue(state['complete'])
+        self.assertEqual(state['changes'], 10)
+
+    def test_resume_complete_crawl(self):
+        self.assertTrue(self.fetch())
+        self.server.queries = []
+        self.assertTrue(self.fetch(resume=True))
+        self.assertFalse(any(q.startswith('N=')
+                             for q in self.server.queries[0]))
+
+    def test_incremental_by_status(self):
+        # Open changes older than the newest merged one.
+        self.server.changes = (
+            [make_change(n, updated='2014-02-20 00:00:00.000000000')
+             for n in range(1, 6)] +
+            [make_change(n, 'NEW') for n in range(6, 11)])
+
+        self.assertTrue(self.fetch(status='merged', incremental=True))
+        self.assertTrue(self.fetch(status='open', incremental=True))
+        self.assertEqual(len(self.change_ids()), 10)
+        self.assertFalse(any('after:' in q for queries in self.server.queries
+                             for q in queries))
+
+        self.server.queries = []
+        self.assertTrue(self.fetch(status='open', incremental=True))
+        self.assertIn('q=status:open+after:%222014-01-01%2010:00:00%22',
+                      self.server.queries[0])
+
+    def test_reviewers(self):
+        yapga.db.insert_changes(self.db, self.server.changes[:3])
+        self.server.reviewers = {'I1': [{'name': 'bob'}],
+                                 'I2': [{'name': 'carol'}]}
+        crawl = 'fetch_reviewers:{}'.format(self.uri)
+
+        self.assertEqual(
+            yapga.fetch.fetch_reviewers(self.db, self.conn, self.uri,
+                                        retries=1),
+            1)
+        state = yapga.db.get_crawl_state(self.db, crawl)
+        self.assertFalse(state['complete'])
+        self.assertEqual(state['remaining'], 1)
+        self.assertEqual(list(yapga.db.changes_missing_reviewers(self.db)),
+                         ['I3'])
+
+        self.server.reviewers['I3'] = []
+        self.assertEqual(
+            yapga.fetch.fetch_reviewers(self.db, self.conn, self.uri,
+                                        retries=1),
+            0)
+        state = yapga.db.get_crawl_state(self.db, crawl)
+        self.assertTrue(state['complete'])
+        self.assertEqual(state['remaining'], 0)
@@ -0,0 +1,233 @@
+import itertools
+import math
+import random
+import unittest
+
+import numpy as np
+
+import yapga.db
+import yapga.graph
+import yapga.snapshot
+import yapga.util
+from yapga.test import temp_sqlite_db
+
+
+def account(account_id, name):
+    return {'_account_id': account_id, 'name': name}
+
+
+ALICE = account(1, 'alice')
+BOB = account(2, 'bob')
+CAROL = account(3, 'carol')
+
+
+class ReviewGraphTests(unittest.TestCase):
+    def setUp(self):
+        changes = [
+            {'change_id': 'I1', 'owner': ALICE},
+            {'change_id': 'I2', 'owner': ALICE},
+            {'change_id': 'I3', 'owner': BOB},
+        ]
+        reviews = [
+            ('I1', [BOB, CAROL]),
+            ('I2', [BOB]),
+            ('I3', [ALICE, ALICE]),
+            ('I4', [CAROL]),
+        ]
+        with temp_sqlite_db(changes, reviews) as db:
+            self.graph = yapga.graph.build(db)
+
+    def test_top(self):
+        self.assertEqual(self.graph.top_reviewers(1), [(2, 2), (3, 1)])
+        self.assertEqual(self.graph.top_reviewers(1, 1), [(2, 2)])
+        self.assertEqual(self.graph.top_owners(1), [(2, 2)])
+        self.assertEqual(self.graph.top_owners(3), [(1, 1)])
+        self.assertEqual(self.graph.review_count(2, 1), 2)
+        self.assertEqual(self.graph.review_count(1, 3), 0)
+
+    def test_reciprocity(self):
+        self.assertEqual(self.graph.reciprocity(1), 1.0)
+        self.assertEqual(self.graph.reciprocity(2), 1.0)
+        self.assertEqual(self.graph.reciprocity(3), 0.0)
+
+    def test_counts_by_name(self):
+        self.assertEqual(sorted(self.graph.owner_counts()),
+                         [('alice', 2), ('bob', 1)])
+        self.assertEqual(sorted(self.graph.reviewer_counts()),
+                         [('alice', 2), ('bob', 2), ('carol', 2)])
+        self.assertEqual(sorted(self.graph.pair_counts()),
+                         [(('alice', 'bob'), 2),
+                          (('bob', 'alice'), 2),
+                          (('carol', 'alice'), 1)])
+
+    def test_counts_in_first_seen_order(self):
+        self.assertEqual(self.graph.owner_counts(),
+                         [('alice', 2), ('bob', 1)])
+        self.assertEqual(self.graph.reviewer_counts(),
+                         [('bob', 2), ('carol', 2), ('alice', 2)])
+
+
+class NameOnlyAccountTests(unittest.TestCase):
+    """Older exports have accounts with a name but no account id."""
+    def setUp(self):
+        changes = [
+            {'change_id': 'I1', 'owner': {'name': 'alice'}},
+            {'change_id': 'I2', 'owner': {'name': 'bob'}},
+            {'change_id': 'I3', 'owner': CAROL},
+            {'change_id': 'I4', 'owner': account(3, 'carol.renamed')},
+        ]
+        reviews = [
+            ('I1', [{'name': 'dave'}]),
+            ('I3', [{'name': 'erin'}]),
+        ]
+        with temp_sqlite_db(changes, reviews) as db:
+            self.graph = yapga.graph.build(db)
+            self.expected = [
+                sorted(yapga.db.owner_change_counts(db)),
+                sorted(yapga.db.reviewer_counts(db)),
+                sorted(yapga.db.reviewer_owner_counts(db)),
+            ]
+
+    def test_nodes(self):
+        self.assertEqual(self.graph.keys,
+                         [('name', 'alice'), ('name', 'bob'), 3,
+                          ('name', 'dave'), ('name', 'erin')])
+        self.assertEqual(self.graph.top_reviewers(('name', 'alice')),
+                         [(('name', 'dave'), 1)])
+        self.assertEqual(self.graph.top_owners(('name', 'erin')), [(3, 1)])
+
+    def test_counts_match_aggregation(self):
+        self.assertEqual(
+            [sorted(self.graph.owner_counts()),
+             sorted(self.graph.reviewer_counts()),
+             sorted(self.graph.pair_counts())],
+            self.expected)
+        self.assertEqual(self.expected[0],
+                         [('alice', 1), ('bob', 1), ('carol', 1),
+                          ('carol.renamed', 1)])
+
+
+def old_most_common(counts, fraction):
+    # How compare_reviewers picked the names from snapshot counts.
+    counts = dict(counts)
+    return list(sorted(
+        x[0] for x in
+        itertools.islice(
+            sorted(counts.items(), key=lambda x: x[1], reverse=True),
+            math.ceil(fraction * len(counts)))))
+
+
+def random_db(rng, names):
+    changes = [{'change_id': 'I{}'.format(n),
+                'owner': {'name': rng.choice(names)},
+                'messages': [{'author': {'name': rng.choice(names)}}
+                             for _ in range(rng.randrange(3))]}
+               for n in range(rng.randrange(1, 12))]
+    reviews = [('I{}'.format(n),
+                [{'name': rng.choice(names)}
+                 for _ in range(rng.randrange(4))])
+               for n in range(rng.randrange(12))]
+    return temp_sqlite_db(changes, reviews)
+
+
+class MostCommonTests(unittest.TestCase):
+    def test_ties_in_order(self):
+        self.assertEqual(
+            yapga.graph.most_common([('b', 2), ('c', 1), ('a', 1)], 0.5),
+            ['b', 'c'])
+        self.assertEqual(
+            yapga.graph.most_common([('b', 2), ('a', 1), ('c', 1)], 0.5),
+            ['a', 'b'])
+        self.assertEqual(yapga.graph.most_common([], 0.5), [])
+
+    def test_matches_snapshot_counts(self):
+        rng = random.Random(1)
+        names = ['n{}'.format(i) for i in range(6)]
+        for case in range(30):
+            with random_db(rng, names) as db:
+                snapshot = yapga.snapshot.build(db)
+                graph = yapga.graph.build(db)
+                sources = {
+                    'owner': [snapshot.counts(snapshot.owner),
+                              list(yapga.db.owner_change_counts(db)),
+                              graph.owner_counts()],
+                    'reviewer': [snapshot.counts(snapshot.reviewer),
+                                 list(yapga.db.reviewer_counts(db)),
+                                 graph.reviewer_counts()],
+                    'author': [snapshot.counts(snapshot.message_author),
+                               list(yapga.db.message_author_counts(db))],
+                }
+
+            for fraction in (1.0, 0.7, 0.5, 0.2):
+                for name, counts in sources.items():
+                    expected = old_most_common(counts[0], fraction)
+                    for c in counts:
+                        self.assertEqual(
+                            yapga.graph.most_common(c, fraction), expected,
+                            (case, fraction, name))
+
+
+def old_pair_matrix(snapshot, reviewers, owners):
+    # How compare_reviewers filled in the matrix from a snapshot.
+    data = np.zeros((len(reviewers), len(owners)))
+    for row, owner in enumerate(snapshot.owner_names()):
+        try:
+            owner_idx = yapga.util.index_of(owners, owner)
+            for reviewer in snapshot.reviewers(row):
+                try:
+                    reviewer_idx = yapga.util.index_of(
+                        reviewers, snapshot.names[reviewer])
+                    data[(reviewer_idx, owner_idx)] += 1
+                except ValueError:
+                    pass
+        except ValueError:
+            pass
+    return data
+
+
+class PairMatrixTests(unittest.TestCase):
+    def setUp(self):
+        changes = [
+            {'change_id': 'I1', 'owner': ALICE},
+            {'change_id': 'I2', 'owner': ALICE},
+            {'change_id': 'I3', 'owner': BOB},
+            {'change_id': 'I4', 'owner': CAROL},
+            {'change_id': 'I5', 'owner': {}},
+        ]
+        reviews = [
+            ('I1', [BOB, CAROL, BOB]),
+            ('I2', [BOB]),
+            ('I3', [ALICE, {}]),
+            ('I4', [ALICE, BOB]),
+            ('I5', [CAROL]),
+            ('I6', [CAROL]),
+        ]
+        with temp_sqlite_db(changes, reviews) as db:
+            self.snapshot = yapga.snapshot.build(db)
+            graph = yapga.graph.build(db)
+            self.pair_counts = [
+                list(yapga.db.reviewer_owner_counts(db)),
+                self.snapshot.reviewer_owner_counts(),
+                graph.pair_counts(),
+            ]
+
+    def test_matches_index_of_loop(self):
+        snapshot = self.snapshot
+        for fraction in (1.0, 0.75, 0.5, 0.25):
+            owners = yapga.graph.most_common(
+                snapshot.counts(snapshot.owner), fraction)
+            reviewers = yapga.graph.most_common(
+                snapshot.counts(snapshot.reviewer), fraction)
+            expected = old_pair_matrix(snapshot, reviewers, owners)
+            for pair_counts in self.pair_counts:
+                np.testing.assert_array_equal(
+                    yapga.graph.pair_matrix(pair_counts, reviewers, owners),
+                    expected)
+
+    def test_empty(self):
+        self.assertEqual(
+            yapga.graph.pair_matrix([], ['alice'], ['bob']).tolist(),
+            [[0.0]])
+        self.assertEqual(
+            yapga.graph.pair_matrix(self.pair_counts[0], [], []).shape,
+            (0, 0))
@@ -0,0 +1,48 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import yapga.snapshot
+from yapga.test import temp_sqlite_db
+
+
+class SnapshotCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'cache')
+
+    def snapshot(self, changes):
+        with temp_sqlite_db(changes) as db:
+            return yapga.snapshot.build(db)
+
+    def test_round_trip(self):
+        snapshot = self.snapshot([
+            {'change_id': 'I1', '_number': 1, 'owner': {'name': 'alice'}},
+            {'change_id': 'I2', '_number': 2, 'owner': {'name': 'bob'}}])
+        yapga.snapshot.save(snapshot, self.path, {'n': 1})
+
+        self.assertIsNone(yapga.snapshot.load_cached(self.path, {'n': 2}))
+        loaded = yapga.snapshot.load_cached(self.path, {'n': 1})
+        self.assertEqual(loaded.number.tolist(), [1, 2])
+        self.assertEqual(loaded.owner_names(), ['alice', 'bob'])
+
+    def test_save_over_loaded(self):
+        yapga.snapshot.save(
+            self.snapshot([{'change_id': 'I1', '_number': 1, 'owner': {}}]),
+            self.path, {'n': 1})
+        loaded = yapga.snapshot.load_cached(self.path)
+
+        yapga.snapshot.save(
+            self.snapshot([{'change_id': 'I1', '_number': 5, 'owner': {}},
+                           {'change_id': 'I2', '_number': 6, 'owner': {}}]),
+            self.path, {'n': 2})
+
+        # The mapped columns of the first save are left alone.
+        self.assertEqual(loaded.number.tolist(), [1])
+        self.assertEqual(
+            yapga.snapshot.load_cached(self.path).number.tolist(), [5, 6])
+        self.assertEqual(
+            len([f for f in os.listdir(self.path)
+                 if f.startswith('columns-')]), 1)
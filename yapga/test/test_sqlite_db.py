@@ -0,0 +1,104 @@
+import unittest
+
+import yapga.db
+import yapga.sqlite_db
+from yapga.test import temp_sqlite_db
+
+
+def make_change(n, owner, authors=(), updated='2013-10-28 10:00:00.000000000'):
+    return {
+        'change_id': 'I{}'.format(n),
+        '_number': n,
+        'status': 'MERGED',
+        'updated': updated,
+        'owner': {'_account_id': len(owner), 'name': owner},
+        'messages': [{'author': {'name': a}} if a else {}
+                     for a in authors],
+    }
+
+
+class SQLiteDatabaseTests(unittest.TestCase):
+    def db(self):
+        return temp_sqlite_db(
+            [make_change(1, 'alice', ['bob', 'bob', None]),
+             make_change(2, 'bob', ['alice']),
+             make_change(3, 'alice', [],
+                         updated='2013-11-01 10:00:00.000000000')],
+            [('I1', [{'name': 'bob'}, {'name': 'carol'}]),
+             ('I2', [{'name': 'alice'}])])
+
+    def test_all_changes(self):
+        with self.db() as db:
+            changes = list(yapga.db.all_changes(db))
+        self.assertEqual([c.change_id for c in changes], ['I1', 'I2', 'I3'])
+        self.assertEqual(changes[0].owner.name, 'alice')
+
+    def test_insert_replaces(self):
+        with self.db() as db:
+            yapga.db.insert_change(db, make_change(1, 'dave'))
+            owners = sorted(c.owner.name for c in yapga.db.all_changes(db))
+        self.assertEqual(owners, ['alice', 'bob', 'dave'])
+
+    def test_reviewers(self):
+        with self.db() as db:
+            reviews = dict(yapga.db.all_reviewers(db))
+            self.assertEqual([r.name for r in reviews['I1']], ['bob', 'carol'])
+            self.assertEqual(len(list(yapga.db.get_reviewers(db, 'I2'))), 1)
+            self.assertEqual(list(yapga.db.get_reviewers(db, 'I3')), [])
+            self.assertEqual(list(yapga.db.changes_missing_reviewers(db)),
+                             ['I3'])
+
+    def test_counts(self):
+        with self.db() as db:
+            self.assertEqual(
+                sorted(yapga.db.owner_change_counts(db)),
+                [('alice', 2), ('bob', 1)])
+            self.assertEqual(
+                sorted(yapga.db.message_author_counts(db)),
+                [('alice', 1), ('bob', 2)])
+            self.assertEqual(
+                sorted(yapga.db.reviewer_counts(db)),
+                [('alice', 1), ('bob', 1), ('carol', 1)])
+            self.assertEqual(
+                sorted(yapga.db.reviewer_owner_counts(db)),
+                [(('alice', 'bob'), 1),
+                 (('bob', 'alice'), 1),
+                 (('carol', 'alice'), 1)])
+
+    def test_high_water_mark(self):
+        with self.db() as db:
+            self.assertEqual(yapga.db.get_high_water_mark(db, 'srv', 'merged'),
+                             '2013-11-01 10:00:00.000000000')
+            yapga.db.set_high_water_mark(db, 'srv', 'merged', '2014-01-01')
+            yapga.db.set_high_water_mark(db, 'srv', 'merged', '2013-01-01')
+            self.assertEqual(yapga.db.get_high_water_mark(db, 'srv', 'merged'),
+                             '2014-01-01')
+
+    def test_high_water_mark_by_status(self):
+        with self.db() as db:
+            yapga.db.set_high_water_mark(db, 'srv', 'merged', '2014-01-01')
+
+            # Only stored changes with the same status are a fallback.
+            self.assertIsNone(yapga.db.get_high_water_mark(db, 'srv', 'open'))
+            self.assertIsNone(
+                yapga.db.get_high_water_mark(db, 'srv', 'reviewed'))
+            self.assertEqual(yapga.db.get_high_water_mark(db, 'srv', 'closed'),
+                             '2013-11-01 10:00:00.000000000')
+            self.assertEqual(
+                yapga.db.get_high_water_mark(db, 'other', 'merged'),
+                '2013-11-01 10:00:00.000000000')
+
+    def test_crawl_state(self):
+        with self.db() as db:
+            self.assertIsNone(yapga.db.get_crawl_state(db, 'crawl'))
+            yapga.db.save_crawl_state(db, 'crawl', sortkey='abc', changes=3)
+            state = yapga.db.get_crawl_state(db, 'crawl')
+        self.assertEqual(state['sortkey'], 'abc')
+        self.assertEqual(state['changes'], 3)
+
+    def test_content_state(self):
+        with self.db() as db:
+            self.assertEqual(yapga.db.content_state(db),
+                             {'changes': 3,
+                              'reviews': 2,
+                              'updated': '2013-11-01 10:00:00.000000000'})
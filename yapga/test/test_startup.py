@@ -0,0 +1,37 @@
+import subprocess
+import unittest
+
+import yapga.util
+
+
+# Modules which are too slow to import on every run of the CLI. They're
+# only imported by the commands which use them.
+HEAVY_MODULES = ['matplotlib', 'nltk', 'numpy']
+
+# The most time (in microseconds) the CLI may take to import. That's
+# several times what it takes without the heavy modules, to leave room
+# for slow machines, but less than matplotlib alone takes.
+CLI_IMPORT_BUDGET = 500000
+
+
+class StartupTests(unittest.TestCase):
+    def assertLight(self, module):
+        times = yapga.util.import_times(module)
+        heavy = sorted(m for m in times
+                       if m.split('.')[0] in HEAVY_MODULES)
+        self.assertEqual(heavy, [],
+                         '{} imports heavy modules'.format(module))
+        return times
+
+    def test_library(self):
+        for module in ['yapga', 'yapga.db', 'yapga.analysis']:
+            self.assertLight(module)
+
+    def test_cli(self):
+        try:
+            yapga.util.import_times('baker')
+        except subprocess.CalledProcessError:
+            self.skipTest('baker can not be imported')
+
+        times = self.assertLight('yapga.app.main')
+        self.assertLess(times['yapga.app.main'], CLI_IMPORT_BUDGET)
@@ -0,0 +1,157 @@
+import gzip
+import hashlib
+import http.server
+import json
+import threading
+import unittest
+import urllib.error
+import urllib.request
+
+import yapga.gerrit_api
+
+
+REALM = 'Gerrit Code Review'
+NONCE = 'abc123'
+USERNAME = 'user'
+PASSWORD = 'secret'
+
+
+def md5(x):
+    return hashlib.md5(x.encode('utf-8')).hexdigest()
+
+
+class StubGerritHandler(http.server.BaseHTTPRequestHandler):
+    """Serves `server.body` for every path under /a/ (with digest
+    authentication) and 404 for everything else.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body, headers=()):
+        self.send_response(status)
+        for k, v in headers:
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self):
+        header = self.headers.get('Authorization')
+        if header is None:
+            return False
+
+        params = urllib.request.parse_keqv_list(
+            urllib.request.parse_http_list(header.partition(' ')[2]))
+        ha1 = md5('{}:{}:{}'.format(USERNAME, REALM, PASSWORD))
+        ha2 = md5('GET:{}'.format(params['uri']))
+        expected = md5('{}:{}:{}:{}:auth:{}'.format(
+            ha1, NONCE, params['nc'], params['cnonce'], ha2))
+        return params['response'] == expected
+
+    def do_GET(self):
+        self.server.requests += 1
+
+        if not self.path.startswith('/a/'):
+            self._send(404, b'Not found')
+            return
+
+        if not self._authorized():
+            self.server.challenges += 1
+            self._send(401, b'Unauthorized', [
+                ('WWW-Authenticate',
+                 'Digest realm="{}", nonce="{}", qop="auth"'.format(
+                     REALM, NONCE))])
+            return
+
+        self.respond()
+
+    def respond(self):
+        """Answer an authorized request."""
+        self._send_json(self.server.body)
+
+    def _send_json(self, value):
+        body = b")]}'\n" + json.dumps(value).encode('utf-8')
+        headers = []
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            headers.append(('Content-Encoding', 'gzip'))
+        self._send(200, body, headers)
+
+
+def serve(test, handler=StubGerritHandler):
+    """Start a server with `handler` in a background thread, shutting
+    it down when the TestCase `test` is cleaned up. Returns the server
+    and the URI of its authenticated REST API.
+    """
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.connections = 0
+    server.requests = 0
+    server.challenges = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    def stop():
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    test.addCleanup(stop)
+    return server, 'http://127.0.0.1:{}/a'.format(server.server_port)
+
+
+class PooledOpenerTests(unittest.TestCase):
+    def setUp(self):
+        self.server, self.uri = serve(self)
+        self.server.body = [{'change_id': 'I{}'.format(i)}
+                            for i in range(100)]
+
+    def connect(self, **kwargs):
+        conn = yapga.gerrit_api.create_connection(
+            self.uri, USERNAME, PASSWORD, pooled=True, **kwargs)
+        self.addCleanup(conn.opener.close)
+        return conn
+
+    def test_request(self):
+        conn = self.connect()
+        self.assertEqual(conn.req(['changes']), self.server.body)
+
+    def test_connection_is_reused(self):
+        conn = self.connect()
+        for _ in range(5):
+            conn.req(['changes'])
+        self.assertEqual(self.server.connections, 1)
+
+    def test_digest_nonce_is_reused(self):
+        conn = self.connect()
+        for _ in range(5):
+            conn.req(['changes'])
+        self.assertEqual(self.server.challenges, 1)
+        self.assertEqual(self.server.requests, 6)
+
+    def test_stream(self):
+        conn = self.connect()
+        self.assertEqual(list(conn.req_stream(['changes'])),
+                         self.server.body)
+        self.assertEqual(conn.req(['changes']), self.server.body)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_gzip(self):
+        conn = self.connect(gzip=True)
+        self.assertEqual(conn.req(['changes']), self.server.body)
+        self.assertEqual(conn.req(['changes']), self.server.body)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_http_error(self):
+        conn = yapga.gerrit_api.create_connection(
+            'http://127.0.0.1:{}'.format(self.server.server_port),
+            pooled=True)
+        self.addCleanup(conn.opener.close)
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            conn.req(['changes'])
+        self.assertEqual(cm.exception.code, 404)
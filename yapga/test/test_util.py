@@ -0,0 +1,93 @@
+import io
+import itertools
+import json
+import threading
+import unittest
+
+import yapga.util
+
+
+class IterJSONArrayTests(unittest.TestCase):
+    def parse(self, data, chunk_size=1):
+        fp = io.BytesIO(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+        return list(yapga.util.iter_json_array(fp, chunk_size=chunk_size))
+
+    def test_empty(self):
+        self.assertEqual(self.parse([]), [])
+
+    def test_objects(self):
+        data = [{'change_id': 'I{}'.format(i), 'files': {'a/b.py': i}}
+                for i in range(20)]
+        for chunk_size in (1, 7, 1024):
+            self.assertEqual(self.parse(data, chunk_size), data)
+
+    def test_scalars(self):
+        data = [12345, 'abc', 1.5e10, None, True, [1, [2]]]
+        self.assertEqual(self.parse(data), data)
+
+    def test_multibyte_characters(self):
+        data = [{'name': 'Jörg 測試'}]
+        self.assertEqual(self.parse(data), data)
+
+    def test_not_an_array(self):
+        with self.assertRaises(ValueError):
+            self.parse({'a': 1})
+
+    def test_truncated(self):
+        fp = io.BytesIO(b'[{"a": 1}, {"b"')
+        with self.assertRaises(ValueError):
+            list(yapga.util.iter_json_array(fp))
+
+
+class JSONLinesTests(unittest.TestCase):
+    def test_iter_json_lines(self):
+        fp = io.BytesIO(b'{"a": 1}\n\n[2]\n"x"\n')
+        self.assertEqual(list(yapga.util.iter_json_lines(fp)),
+                         [{'a': 1}, [2], 'x'])
+
+    def test_is_json_array(self):
+        fp = io.BufferedReader(io.BytesIO(b' \n [{"a": 1}]'))
+        self.assertTrue(yapga.util.is_json_array(fp))
+        self.assertEqual(list(yapga.util.iter_json_array(fp)), [{'a': 1}])
+
+        fp = io.BufferedReader(io.BytesIO(b'{"a": 1}\n'))
+        self.assertFalse(yapga.util.is_json_array(fp))
+        self.assertEqual(list(yapga.util.iter_json_lines(fp)), [{'a': 1}])
+
+
+class PrefetchTests(unittest.TestCase):
+    def source(self, count=None):
+        # Generates integers, recording how many and when it's closed.
+        self.produced = 0
+        self.closed = threading.Event()
+        try:
+            for i in itertools.islice(itertools.count(), count):
+                self.produced += 1
+                yield i
+        finally:
+            self.closed.set()
+
+    def test_all_items(self):
+        self.assertEqual(list(yapga.util.prefetch(self.source(100), 3)),
+                         list(range(100)))
+        self.assertTrue(self.closed.wait(5))
+
+    def test_exception(self):
+        def fail():
+            yield 1
+            raise ValueError('oops')
+
+        items = yapga.util.prefetch(fail(), 3)
+        self.assertEqual(next(items), 1)
+        with self.assertRaises(ValueError):
+            next(items)
+
+    def test_consumer_stops_early(self):
+        items = yapga.util.prefetch(self.source(), 3)
+        self.assertEqual(list(itertools.islice(items, 5)), list(range(5)))
+        items.close()
+
+        # The producer closes the (endless) source rather than
+        # blocking forever on a full buffer.
+        self.assertTrue(self.closed.wait(5))
+        self.assertLessEqual(self.produced, 5 + 3 + 1)
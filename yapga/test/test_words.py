@@ -0,0 +1,59 @@
+import re
+import unittest
+
+import yapga.stopwords
+import yapga.words
+
+
+MESSAGES = [
+    'Uploaded patch set 1.',
+    'Uploaded patch set 12.',
+    'Uploaded patch set x.',
+    'Change has been successfully merged into the git repository.',
+    'Change 123 has been successfully merged into the branch',
+    'Patch Set 2: Looks good to me, approved',
+    'Patch Set 3: Code-Review+1\n\nNice cleanup (2 inline comments)',
+    'Patch Set 4:\n\n(1 inline comment)',
+    'Please rebase.',
+    'Not the merged change',
+]
+
+
+def old_filter_messages(messages):
+    # The original filter_messages, matching each of `skip_res` in turn.
+    for msg in messages:
+        if any(re.match(patt, msg) for patt in yapga.words.skip_res):
+            continue
+
+        for patt in yapga.words.trim_res:
+            match = re.search(patt, msg)
+            if match:
+                msg = ' '.join(match.groups())
+
+        yield msg
+
+
+class FilterMessagesTests(unittest.TestCase):
+    def test_matches_old_filter(self):
+        self.assertEqual(list(yapga.words.filter_messages(MESSAGES)),
+                         list(old_filter_messages(MESSAGES)))
+
+    def test_skips(self):
+        self.assertEqual(
+            list(yapga.words.filter_messages(MESSAGES[:6])),
+            ['Uploaded patch set x.'])
+
+
+class FilterWordsTests(unittest.TestCase):
+    def test_lowercase_stopwords_dropped(self):
+        # The old check compared uppercased words with the (lowercase)
+        # NLTK stopwords, so never dropped them.
+        words = ['this', 'should', 'be', 'merged']
+        self.assertTrue(set(words[:3]) <= set(yapga.stopwords.ENGLISH))
+        self.assertEqual(list(yapga.words.filter_words(words)), ['merged'])
+
+    def test_case_insensitive(self):
+        self.assertEqual(
+            list(yapga.words.filter_words(
+                ['PATCH', 'patch', 'The', 'code-review+2', 'Fix'])),
+            ['Fix'])
@@ -1,5 +1,24 @@
 import bisect
+import codecs
+import gzip
 import itertools
+import json
+import logging
+import os
+import queue
+import re
+import subprocess
+import sys
+import threading
+import time
+
+import yapga.gerrit_api
+
+
+log = logging.getLogger('yapga')
+
+# Where snapshots and other derived data are cached.
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'yapga')
 
 
 def chunks(it, size):
@@ -35,4 +54,243 @@ def is_empty(i):
         next(iter(i))
         return False
     except StopIteration:
-        return True
\ No newline at end of file
+        return True
+
+
+_PREFETCH_DONE = object()
+
+
+def prefetch(it, depth):
+    """Iterate `it` in a background thread, keeping up to `depth`
+    items buffered ahead of the consumer.
+
+    This lets slow producers (e.g. network requests) overlap with
+    whatever the consumer does with each item. Exceptions raised by
+    `it` are re-raised in the consumer.
+
+    If the consumer stops early (closing this generator, or dropping
+    it), the thread stops iterating, closes `it` if it can be closed
+    and exits.
+    """
+    buf = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        # Wait for room in the buffer, unless the consumer has gone.
+        while not stop.is_set():
+            try:
+                buf.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        items = iter(it)
+        try:
+            for x in items:
+                if not put((x, None)):
+                    break
+            else:
+                put((_PREFETCH_DONE, None))
+        except Exception as e:
+            put((None, e))
+        finally:
+            close = getattr(items, 'close', None)
+            if close is not None:
+                close()
+
+        # Drop anything the consumer didn't take.
+        if stop.is_set():
+            while not buf.empty():
+                buf.get_nowait()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            x, exc = buf.get()
+            if exc is not None:
+                raise exc
+            if x is _PREFETCH_DONE:
+                return
+            yield x
+    finally:
+        stop.set()
+
+
+def retry(func, attempts, delay=1.0, exceptions=(Exception,),
+          transient=None):
+    """Call `func` until it succeeds, at most `attempts` times.
+
+    After each failure raising one of `exceptions` (for which
+    `transient(exc)` is true, if `transient` is given) we sleep for
+    `delay` seconds, doubling the delay each time. The exception from
+    the final attempt is re-raised.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return func()
+        except exceptions as e:
+            if attempt >= attempts or (transient and not transient(e)):
+                raise
+            log.warning('Attempt {} of {} failed. Retrying in {}s.'.format(
+                attempt, attempts, delay), exc_info=True)
+            time.sleep(delay)
+            delay *= 2
+
+
+class RateLimiter:
+    """Limit callers of `wait()` to `rate` calls per second, across all
+    threads. A `rate` of zero or less means no limit.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            wait_until = max(now, self.next_time)
+            self.next_time = wait_until + self.interval
+
+        time.sleep(wait_until - now)
+
+
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def iter_json_array(fp, chunk_size=64 * 1024):
+    """Incrementally parse the JSON array in the binary file-like `fp`,
+    generating its elements one at a time.
+
+    Only about one element (plus `chunk_size` bytes) is held in memory
+    at once, rather than the whole document.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def read_more(size):
+        nonlocal buf, pos, eof
+        data = fp.read(max(size, chunk_size))
+        if not data:
+            eof = True
+        buf = buf[pos:] + text.decode(data, final=eof)
+        pos = 0
+
+    def next_char():
+        nonlocal pos
+        while True:
+            pos = _JSON_WHITESPACE.match(buf, pos).end()
+            if pos < len(buf):
+                return buf[pos]
+            if eof:
+                raise ValueError('Unexpected end of JSON array')
+            read_more(chunk_size)
+
+    if next_char() != '[':
+        raise ValueError('Expected a JSON array')
+    pos += 1
+
+    if next_char() == ']':
+        return
+
+    while True:
+        next_char()
+
+        # Keep reading until the element parses and isn't butting up
+        # against the end of the buffer (where e.g. a number might
+        # only be partially read.) Doubling the read size each time
+        # keeps this linear in the size of the element.
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+                if end < len(buf) or eof:
+                    break
+            except ValueError:
+                if eof:
+                    raise
+            read_more(len(buf) - pos)
+
+        pos = end
+        yield value
+
+        c = next_char()
+        pos += 1
+        if c == ']':
+            return
+        if c != ',':
+            raise ValueError(
+                'Expected "," or "]" in JSON array, found {!r}'.format(c))
+
+
+def iter_json_lines(fp):
+    """Generate the values in the JSON Lines file-like `fp`, one per
+    line. Blank lines are skipped.
+    """
+    for line in fp:
+        if line.strip():
+            yield json.loads(line)
+
+
+def is_json_array(fp):
+    """Check whether the buffered binary file-like `fp` holds a JSON
+    array (rather than JSON Lines.) Only leading whitespace is consumed.
+    """
+    while True:
+        c = fp.peek(1)[:1]
+        if not c.isspace():
+            return c == b'['
+        fp.read(1)
+
+
+def open_file(filename, mode='rt'):
+    """Open `filename` with `mode`, compressing or decompressing it
+    with gzip if its name ends in '.gz'.
+    """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+
+def import_times(module):
+    """Import `module` in a fresh interpreter with `-X importtime`,
+    returning a map from each module it imported to the cumulative time
+    (in microseconds) taken to import it.
+
+    Raises:
+        subprocess.CalledProcessError: The import failed.
+    """
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            times[fields[2].strip()] = int(fields[1])
+        except (IndexError, ValueError):
+            # The header line.
+            continue
+    return times
+
+
+def all_changes(filename):
+    """Read a JSON list of `ChangeInfo` objects from `filename`,
+    generating a `Change` for each.
+    """
+    with open(filename, 'rb') as f:
+        for c in iter_json_array(f):
+            yield yapga.gerrit_api.Change(c)
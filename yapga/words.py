@@ -0,0 +1,96 @@
+import collections
+import functools
+import itertools
+import logging
+import re
+
+import yapga.stopwords
+
+
+log = logging.getLogger('yapga')
+
+
+def english_stopwords():
+    """NLTK's English stopwords, or the bundled copy of them if NLTK
+    or its stopwords corpus isn't installed.
+    """
+    try:
+        from nltk.corpus import stopwords as nltk_stopwords
+        return nltk_stopwords.words('english')
+    except (ImportError, LookupError):
+        log.info('NLTK stopwords unavailable. Using the bundled list.')
+        return yapga.stopwords.ENGLISH
+
+@functools.lru_cache(maxsize=None)
+def skip_words():
+    """The words not worth counting, casefolded. NLTK is only loaded
+    the first time they're needed.
+    """
+    return frozenset(w.casefold() for w in itertools.chain(
+        [
+            'Patch',
+            'Set',
+            'the',
+            'a',
+            'an',
+            'to',
+            'Code-Review+1',
+            'Code-Review+2',
+            'Code-Review-1',
+            'Code-Review-2',
+            'Verified+1',
+            'Verfied',
+        ],
+        map(''.join,
+            itertools.product(map(str, range(10)),
+                              ':.')),
+        english_stopwords()))
+
+skip_res = [
+    r'Uploaded patch set \d+.',
+    'Change has been successfully merged into the git repository.',
+    r'Change \d+ has been successfully merged into the.*',
+    '.*Looks good to me.*',
+]
+
+# Messages matching any of `skip_res` are skipped with a single match.
+skip_re = re.compile('|'.join('(?:{})'.format(patt) for patt in skip_res))
+
+trim_res = [
+    r"Patch Set \d+: (.*)",
+    r'(.*)\(\d+ inline comments?\)(.*)',
+]
+
+trim_res = [re.compile(patt, flags=re.DOTALL)
+            for patt in trim_res]
+
+def filter_messages(messages):
+    skip = skip_re.match
+    trims = [patt.search for patt in trim_res]
+
+    for msg in messages:
+        if skip(msg):
+            continue
+
+        for trim in trims:
+            match = trim(msg)
+            if match:
+                msg = ' '.join(match.groups())
+
+        yield msg
+
+def filter_words(words):
+    # Not memoized: a cache of every distinct token would grow with
+    # the corpus, and costs more memory than the casefold saves time.
+    skip = skip_words()
+    return (w for w in words if w.casefold() not in skip)
+
+def message_words(messages):
+    """Generate the words worth counting in `messages`."""
+    return filter_words(w for m in filter_messages(messages)
+                        for w in m.split())
+
+
+def count_words(messages):
+    """Count the words worth counting in `messages`."""
+    return collections.Counter(message_words(messages))